@@ -0,0 +1,96 @@
+import time
+
+
+# (name, setup function)
+registry = []
+# name -> the longest median run time allowed, in seconds
+budgets = {}
+
+
+def benchmark(name, budget=None):
+    # A benchmark's setup function returns (run, n_items). run() is timed
+    # as a whole, and n_items is the number of items it processes, e.g.
+    # messages dispatched or playlist entries written.
+    def decorator(setup):
+        registry.append((name, setup))
+        if budget is not None:
+            budgets[name] = budget
+        return setup
+    return decorator
+
+
+def run_benchmark(setup, repeat):
+    run, n_items = setup()
+    run()   # Warm up
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    median = timings[len(timings) // 2]
+    return {
+        'items': n_items,
+        'runs': repeat,
+        'min': timings[0],
+        'median': median,
+        'mean': sum(timings) / len(timings),
+        'items_per_sec': n_items / median if median > 0 else None,
+    }
+
+
+class NullLogger:
+    OUTPUT_FORMATS = ['text', 'json']
+
+    def __init__(self, writer=None, output_format='text'):
+        self.writer = writer
+        self.output_format = output_format
+
+    def set_output_format(self, output_format):
+        self.output_format = output_format
+
+    def print_to_str(self, *args, **kwargs):
+        return ''
+
+    def emit(self, level, msg):
+        pass
+
+    def write_pending(self):
+        pass
+
+    async def flush(self):
+        pass
+
+    def debug(self, *args, **kwargs):
+        pass
+
+    def info(self, *args, **kwargs):
+        pass
+
+    def warning(self, *args, **kwargs):
+        pass
+
+    def error(self, *args, **kwargs):
+        pass
+
+
+def make_song_list(n_songs):
+    return [{
+        'id': 100000 + i,
+        'name': 'Song {}'.format(i),
+        'artists': [{'name': 'Artist {}'.format(i % 97)}],
+        'album': {'name': 'Album {}'.format(i % 31)},
+        'duration': 240000,
+    } for i in range(n_songs)]
+
+
+def make_url_info_list(song_list):
+    return [{
+        'id': s['id'],
+        'url': 'http://m10.music.126.net/{}.mp3'.format(s['id']),
+        'br': 320000,
+        'size': 9600000,
+        'md5': '0' * 32,
+        'expi': 1200,
+        'code': 200,
+    } for s in song_list]
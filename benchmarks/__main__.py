@@ -0,0 +1,123 @@
+import sys
+import time
+import json
+import argparse
+import platform
+import subprocess
+
+from . import (registry, budgets, run_benchmark)
+# Imported for registering the benchmarks
+from . import (encrypt, player, playlist, page, startup)
+
+
+DEFAULT_REPEAT = 5
+# A benchmark regresses when its median gets this much slower
+DEFAULT_THRESHOLD = 0.1
+
+
+def get_git_commit():
+    try:
+        out = subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode().strip()
+
+
+def run_all(name_filter, repeat):
+    results = {}
+    for name, setup in registry:
+        if name_filter and not any([f in name for f in name_filter]):
+            continue
+        print('Running {}...'.format(name), file=sys.stderr)
+        results[name] = run_benchmark(setup, repeat)
+    return {
+        'commit': get_git_commit(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+
+def compare(base, report, threshold):
+    regressions = []
+    print('{:45} {:>12} {:>12} {:>8}'.format(
+        'benchmark', 'base (ms)', 'this (ms)', 'change'), file=sys.stderr)
+    for name, r in sorted(report['results'].items()):
+        base_r = base['results'].get(name)
+        if base_r is None:
+            print('{:45} {:>12} {:>12.3f} {:>8}'.format(
+                name, '-', r['median'] * 1000, 'new'), file=sys.stderr)
+            continue
+        change = r['median'] / base_r['median'] - 1
+        print('{:45} {:>12.3f} {:>12.3f} {:>+7.1f}%'.format(
+            name, base_r['median'] * 1000, r['median'] * 1000, change * 100),
+            file=sys.stderr)
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def check_budgets(report):
+    over = []
+    for name, r in sorted(report['results'].items()):
+        budget = budgets.get(name)
+        if budget is not None and r['median'] > budget:
+            print('{}: {:.3f} ms, budget is {:.3f} ms'.format(
+                name, r['median'] * 1000, budget * 1000), file=sys.stderr)
+            over.append(name)
+    return over
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            prog='python -m benchmarks',
+            description='Run the offline benchmarks for music163')
+    parser.add_argument('filter', nargs='*',
+            help='only run benchmarks whose names contain one of these')
+    parser.add_argument('-r', '--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('-o', '--output',
+            help='write the JSON report here instead of stdout')
+    parser.add_argument('-c', '--compare',
+            help='compare with a JSON report from a previous run')
+    parser.add_argument('-t', '--threshold', type=float,
+            default=DEFAULT_THRESHOLD)
+    parser.add_argument('-l', '--list', action='store_true',
+            help='list the benchmarks and exit')
+    args = parser.parse_args()
+
+    if args.list:
+        for name, _setup in registry:
+            print(name)
+        return
+
+    report = run_all(args.filter, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as out_file:
+            json.dump(report, out_file, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    failed = False
+    over = check_budgets(report)
+    if over:
+        print('Over budget: {}'.format(', '.join(over)), file=sys.stderr)
+        failed = True
+
+    if args.compare:
+        with open(args.compare, 'r') as in_file:
+            base = json.load(in_file)
+        regressions = compare(base, report, args.threshold)
+        if regressions:
+            print('Regressions: {}'.format(', '.join(regressions)),
+                    file=sys.stderr)
+            failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
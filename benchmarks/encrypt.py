@@ -0,0 +1,60 @@
+from music163.api import Music163API
+
+from . import benchmark
+
+
+N_CALLS = 500
+BATCH_SIZE = 50
+PAYLOAD = {
+    'ids': '[{}]'.format(','.join([str(i) for i in range(50)])),
+    'br': 320000,
+}
+
+
+@benchmark('api.encrypt_data')
+def bench_encrypt_data():
+    api = Music163API()
+
+    def run():
+        for _ in range(N_CALLS):
+            api.encrypt_data(PAYLOAD, api.gen_enc_key())
+
+    return (run, N_CALLS)
+
+
+@benchmark('api.encrypt_data.session_key')
+def bench_encrypt_data_session_key():
+    api = Music163API()
+    api.set_enc_key_reuse(True)
+
+    def run():
+        for _ in range(N_CALLS):
+            api.encrypt_data(PAYLOAD, api.gen_enc_key())
+
+    return (run, N_CALLS)
+
+
+@benchmark('api.encrypt_data_batch')
+def bench_encrypt_data_batch():
+    api = Music163API()
+    api.set_enc_key_reuse(True)
+    batch = [PAYLOAD] * BATCH_SIZE
+    n_batches = N_CALLS // BATCH_SIZE
+
+    def run():
+        for _ in range(n_batches):
+            api.encrypt_data_batch(batch, api.gen_enc_key())
+
+    return (run, n_batches * BATCH_SIZE)
+
+
+@benchmark('api.aes_encrypt')
+def bench_aes_encrypt():
+    api = Music163API()
+    msg = b'{"ids":"[1,2,3,4,5,6,7,8,9,10]","br":320000}'
+
+    def run():
+        for _ in range(N_CALLS):
+            api.aes_encrypt(msg, api.ENC_AES_KEY0)
+
+    return (run, N_CALLS)
@@ -0,0 +1,53 @@
+from music163.page import (CHUNK_SIZE, LinkExtractor, extract_song_ids)
+
+from . import benchmark
+
+
+N_SONGS = 5000
+
+
+def make_chart_page(n_songs):
+    # Roughly what a chart page looks like: lots of markup, a few links
+    # per row, and the song list in a hidden <ul>
+    rows = []
+    for i in range(n_songs):
+        rows.append(
+                '<tr><td><span class="num">{0}</span></td>'
+                '<td><div class="tt"><a href="/song?id={1}"><b title="Song {0}">'
+                'Song {0}</b></a></div></td>'
+                '<td><a href="/artist?id={2}">Artist {2}</a></td>'
+                '<td><a href="/album?id={3}">Album {3}</a></td></tr>'
+                .format(i, 100000 + i, i % 97, i % 31))
+    hidden = ''.join(
+            ['<li><a href="/song?id={}">Song</a></li>'.format(100000 + i)
+             for i in range(n_songs)])
+    return (
+            '<!DOCTYPE html><html><head><title>Chart</title></head><body>'
+            '<div class="g-bd"><table>{}</table>'
+            '<ul class="f-hide">{}</ul></div></body></html>'
+            .format(''.join(rows), hidden))
+
+
+@benchmark('cmd.extract_song_ids')
+def bench_extract_song_ids():
+    page = make_chart_page(N_SONGS)
+
+    def run():
+        extract_song_ids(page)
+
+    return (run, N_SONGS)
+
+
+@benchmark('page.extract_links.streamed')
+def bench_extract_links_streamed():
+    # The page as it comes from the network, chunk by chunk
+    data = make_chart_page(N_SONGS).encode()
+    chunks = [data[i:i+CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE)]
+
+    def run():
+        extractor = LinkExtractor()
+        for c in chunks:
+            extractor.feed(c)
+        extractor.close()
+
+    return (run, N_SONGS)
@@ -0,0 +1,194 @@
+import sys
+import asyncio
+
+from music163.player import (Mpg123, AsyncLogger)
+from music163.cache import UrlCache
+
+from . import (benchmark, NullLogger, make_song_list, make_url_info_list)
+
+
+N_MESSAGES = 20000
+N_SKIPS = 200
+PLAYLIST_SIZES = [10, 1000, 100000]
+N_TRANSITIONS = 200
+N_LOG_LINES = 20000
+# Simulated seconds per track, about 40 frames with the fake player
+TRACK_LENGTH = 1
+FAKE_MPG123 = [sys.executable, '-m', 'music163.fakempg123']
+
+
+class BenchPlayer(Mpg123):
+    def invoke_cmd(self, cmd):
+        pass
+
+
+class FakeProcess:
+    def __init__(self, stdout):
+        self.stdout = stdout
+
+
+def make_player(song_list=None):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    url_cache = None
+    if song_list is not None:
+        url_cache = UrlCache(max_entries=len(song_list))
+        url_cache.put_many(make_url_info_list(song_list), 320000)
+    player = BenchPlayer(loop=loop, url_cache=url_cache)
+    player.logger = NullLogger()
+    if song_list is not None:
+        player.set_playlist(song_list)
+    return player
+
+
+def make_message_stream(n_messages):
+    # Mostly frame reports, like what mpg123 sends during playback
+    msgs = []
+    frames_left = n_messages
+    for i in range(n_messages):
+        if i % 1000 == 0:
+            msgs.append(b'@P 2')
+        elif i % 1000 == 1:
+            msgs.append(b'@S 1.0 3 44100 Joint-Stereo 0 1044 2 0 0 0 320 0 1')
+        elif i % 1000 == 2:
+            msgs.append(b'@I ID3:Song name')
+        else:
+            msgs.append('@F {} {} {:.2f} {:.2f}'.format(
+                i, frames_left, i * 0.026, frames_left * 0.026).encode())
+        frames_left -= 1
+    return msgs
+
+
+@benchmark('player.handle_msg')
+def bench_handle_msg():
+    player = make_player()
+    msgs = make_message_stream(N_MESSAGES)
+
+    def run():
+        for m in msgs:
+            player.handle_msg(m)
+
+    return (run, N_MESSAGES)
+
+
+@benchmark('player.on_frame')
+def bench_on_frame():
+    player = make_player()
+    msgs = [m for m in make_message_stream(N_MESSAGES) if m.startswith(b'@F')]
+
+    def run():
+        for m in msgs:
+            player._on_frame(m)
+
+    return (run, len(msgs))
+
+
+@benchmark('player.dispatch')
+def bench_dispatch():
+    player = make_player()
+    data = b'\n'.join(make_message_stream(N_MESSAGES)) + b'\n'
+
+    def run():
+        reader = asyncio.StreamReader(loop=player.loop)
+        reader.feed_data(data)
+        reader.feed_eof()
+        player.process = FakeProcess(reader)
+        player.loop.run_until_complete(player.dispatch())
+
+    return (run, N_MESSAGES)
+
+
+class CountingWriter:
+    # Stands in for the stdout stream writer
+    def __init__(self):
+        self.n_bytes = 0
+        self.n_writes = 0
+
+    def write(self, data):
+        self.n_bytes += len(data)
+        self.n_writes += 1
+
+    async def drain(self):
+        pass
+
+
+@benchmark('player.logger.info')
+def bench_logger_info():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    logger = AsyncLogger(CountingWriter())
+
+    async def log():
+        for i in range(N_LOG_LINES):
+            logger.info('{:05}. Artist {} - Song {}'.format(i, i % 97, i))
+        await logger.flush()
+
+    def run():
+        loop.run_until_complete(log())
+
+    return (run, N_LOG_LINES)
+
+
+def make_shuffle_bench(n_songs):
+    def setup():
+        player = make_player(make_song_list(n_songs))
+        player.set_shuffle(True)
+        # Start from the middle of the shuffled order, the cost of finding
+        # the current position may depend on it
+        player.current_song = player.shuffle_order.order[n_songs // 2]
+
+        async def skip():
+            for _ in range(N_SKIPS):
+                await player.play_next_song()
+
+        def run():
+            player.loop.run_until_complete(skip())
+
+        return (run, N_SKIPS)
+    return setup
+
+
+for n in PLAYLIST_SIZES:
+    benchmark('player.play_next_song.shuffle.{}'.format(n))(
+            make_shuffle_bench(n))
+
+
+class TransitionPlayer(Mpg123):
+    # Stops after a number of track ends, instead of playing forever
+    async def play_next_song(self):
+        self.transitions += 1
+        if self.transitions >= N_TRANSITIONS:
+            if not self.done.done():
+                self.done.set_result(None)
+            return
+        await super(TransitionPlayer, self).play_next_song()
+
+
+@benchmark('player.track_transition')
+def bench_track_transition():
+    song_list = make_song_list(N_TRANSITIONS)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    url_cache = UrlCache(max_entries=len(song_list))
+    url_cache.put_many(make_url_info_list(song_list), 320000)
+    player = TransitionPlayer(
+            binary=FAKE_MPG123,
+            extra_args=['--frame-rate', '0',
+                        '--track-length', str(TRACK_LENGTH)],
+            loop=loop, url_cache=url_cache)
+    player.logger = NullLogger()
+    player.set_playlist(song_list)
+    # The fake player exits when its stdin gets closed
+    loop.run_until_complete(player.start_process())
+
+    def run():
+        player.transitions = 0
+        player.done = loop.create_future()
+        dispatcher = asyncio.ensure_future(player.dispatch())
+        loop.run_until_complete(player.play_song_in_playlist(0))
+        loop.run_until_complete(player.done)
+        dispatcher.cancel()
+        loop.run_until_complete(
+                asyncio.gather(dispatcher, return_exceptions=True))
+
+    return (run, N_TRANSITIONS)
@@ -0,0 +1,30 @@
+import io
+
+from music163.api import Music163API
+from music163.cache import UrlCache
+from music163.playlist import (generate_simple, generate_pls)
+
+from . import (benchmark, make_song_list, make_url_info_list)
+
+
+PLAYLIST_SIZE = 10000
+BIT_RATE = 320000
+
+
+def make_generate_bench(gen_func):
+    def setup():
+        api = Music163API()
+        song_list = make_song_list(PLAYLIST_SIZE)
+        # All URLs are cached, so no request is ever sent
+        url_cache = UrlCache(max_entries=PLAYLIST_SIZE)
+        url_cache.put_many(make_url_info_list(song_list), BIT_RATE)
+
+        def run():
+            gen_func(api, song_list, BIT_RATE, io.StringIO(), url_cache)
+
+        return (run, PLAYLIST_SIZE)
+    return setup
+
+
+benchmark('playlist.generate_simple')(make_generate_bench(generate_simple))
+benchmark('playlist.generate_pls')(make_generate_bench(generate_pls))
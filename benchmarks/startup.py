@@ -0,0 +1,21 @@
+import sys
+import subprocess
+
+from . import benchmark
+
+
+# Scripts may run the CLI many times in a row, and pay for this every
+# time. Loading the player, aiohttp or lxml here would blow the budget.
+CLI_STARTUP_BUDGET = 0.3
+
+
+@benchmark('startup.cli', budget=CLI_STARTUP_BUDGET)
+def bench_cli_startup():
+    # A fresh interpreter importing what 'python -m music163' imports
+    # before running a command
+    cmd = [sys.executable, '-c', 'import music163.__main__']
+
+    def run():
+        subprocess.check_call(cmd)
+
+    return (run, 1)
@@ -1,3 +1,4 @@
+import os
 import types
 import base64
 import codecs
@@ -5,15 +6,40 @@ import json
 import random
 import hashlib
 import urllib.parse as urlparse
+import urllib.request as urlrequest
 
 import requests
-from Crypto.Cipher import AES
-from Crypto.PublicKey import RSA
 from Crypto import Random
+# aiohttp and Crypto.Cipher take a while to load, and the CLI doesn't
+# always need them. They are imported where they're used.
 
 
-MUSIC_163_DOMAIN = 'music.163.com'
-MUSIC_163_SCHEME = 'https'
+# These can be pointed at a local stand-in server (see devserver.py)
+MUSIC_163_DOMAIN = os.environ.get('MUSIC_163_DOMAIN', 'music.163.com')
+MUSIC_163_SCHEME = os.environ.get('MUSIC_163_SCHEME', 'https')
+MUSIC_163_HOST = urlparse.urlsplit('//' + MUSIC_163_DOMAIN).hostname
+
+ENC_RSA_MODULUS = os.environ.get(
+        'MUSIC_163_RSA_MODULUS',
+        '00e0b509f6259df8642dbc3566290147'
+        '7df22677ec152b5ff68ace615bb7b725'
+        '152b3ab17a876aea8a5aa76d2e417629'
+        'ec4ee341f56135fccf695280104e0312'
+        'ecbda92557c93870114af6c9d05c4f7f'
+        '0c3685b7a46bee255932575cce10b424'
+        'd813cfe4875d3e82047b97ddef52741d'
+        '546b8e289dc6935b3ece0462db0a22b8e7')
+
+
+_AES = None
+
+
+def get_aes():
+    global _AES
+    if _AES is None:
+        from Crypto.Cipher import AES
+        _AES = AES
+    return _AES
 
 
 class APIError(Exception):
@@ -21,6 +47,8 @@ class APIError(Exception):
 
 
 class Profile(dict):
+    filename = None
+
     def set_filename(self, filename):
         self.filename = filename
 
@@ -34,16 +62,19 @@ class Profile(dict):
             self.update(json_obj)
 
 
+def build_api_headers():
+    # This referer header is needed for passing cross-site-request checks
+    return {
+        'Referer': urlparse.urlunparse((
+            MUSIC_163_SCHEME, MUSIC_163_DOMAIN, '/', '', '', '')),
+        'User-Agent': 'Mozilla/5.0 (X11; Fedora; Linux x86_64; rv:60.0) Gecko/20100101 Firefox/60.0',
+    }
+
+
 class APISession(requests.Session):
     def __init__(self):
         super(APISession, self).__init__()
-        # This referer header is needed for passing cross-site-request checks
-        headers = {
-            'Referer': urlparse.urlunparse((
-                MUSIC_163_SCHEME, MUSIC_163_DOMAIN, '/', '', '', '')),
-            'User-Agent': 'Mozilla/5.0 (X11; Fedora; Linux x86_64; rv:60.0) Gecko/20100101 Firefox/60.0',
-        }
-        self.headers.update(headers)
+        self.headers.update(build_api_headers())
 
 
 class APIFunc:
@@ -63,6 +94,12 @@ class APIFunc:
 
         self.kwargs = kwargs
 
+    def __get__(self, api_obj, owner=None):
+        # Bound like a method when looked up on an API object
+        if api_obj is None:
+            return self
+        return types.MethodType(self, api_obj)
+
     def __call__(self, api_obj, *args):
         args_num = len(self.params) + len(self.data)
         if len(args) != args_num:
@@ -112,6 +149,13 @@ class Music163API:
         data=['id'],
     )
 
+    # Returns all the track IDs, but details for only the first 'n' tracks
+    playlist_detail_v3 = APIFunc(
+        '/weapi/v3/playlist/detail',
+        encrypted=True,
+        data=['id', 'n'],
+    )
+
     song_detail = APIFunc(
         '/weapi/song/detail',
         encrypted=True,
@@ -182,27 +226,11 @@ class Music163API:
         data=['logs'],
     )
 
-    ENC_RSA_KEY = RSA.construct((
-        int(b'00e0b509f6259df8642dbc3566290147' +
-            b'7df22677ec152b5ff68ace615bb7b725' +
-            b'152b3ab17a876aea8a5aa76d2e417629' +
-            b'ec4ee341f56135fccf695280104e0312' +
-            b'ecbda92557c93870114af6c9d05c4f7f' +
-            b'0c3685b7a46bee255932575cce10b424' +
-            b'd813cfe4875d3e82047b97ddef52741d' +
-            b'546b8e289dc6935b3ece0462db0a22b8e7', 16),
-        0x010001))
+    ENC_RSA_N = int(ENC_RSA_MODULUS, 16)
+    ENC_RSA_E = 0x010001
     ENC_AES_IV = b'0102030405060708'
     ENC_AES_KEY0 = b'0CoJUm6Qyw8W8jud'
 
-    def __new__(cls, *args, **kwargs):
-        obj = super(Music163API, cls).__new__(cls)
-        for a in dir(obj):
-            attr = getattr(obj, a)
-            if isinstance(attr, APIFunc):
-                setattr(obj, a, types.MethodType(attr, obj))
-        return obj
-
     def __init__(self, session=None, profile=None):
         if session is None:
             session = APISession()
@@ -212,8 +240,22 @@ class Music163API:
         self.profile = profile
         self.rand = Random.new()
         self.request_timeout = None
+        self.enc_key_reuse = False
+        self.session_enc_key = None
+        # (enc_key, encSecKey) of the last RSA encryption
+        self.last_rsa_result = (None, None)
+
+    def set_enc_key_reuse(self, enabled):
+        self.enc_key_reuse = enabled
+        self.session_enc_key = None
 
     def gen_enc_key(self):
+        if self.enc_key_reuse:
+            # One key for the whole session, so that its encSecKey only
+            # needs to be computed once
+            if self.session_enc_key is None:
+                self.session_enc_key = codecs.encode(self.rand.read(8), 'hex')
+            return self.session_enc_key
         return codecs.encode(self.rand.read(8), 'hex')
 
     def aes_encrypt(self, msg, key):
@@ -222,32 +264,45 @@ class Music163API:
         pad_bytes[0] = pad
         pad_bytes = pad_bytes * pad
         msg = msg + pad_bytes
-        encryptor = AES.new(key, AES.MODE_CBC, self.ENC_AES_IV)
+        aes = get_aes()
+        encryptor = aes.new(key, aes.MODE_CBC, self.ENC_AES_IV)
         ciphertext = encryptor.encrypt(msg)
         ciphertext = base64.b64encode(ciphertext)
         return ciphertext
 
     def rsa_encrypt(self, msg):
-        rs = self.ENC_RSA_KEY.encrypt(msg[::-1], b'')[0]
-        rs = codecs.encode(rs, 'hex')
-        return rs.decode()
+        if self.last_rsa_result[0] == msg:
+            return self.last_rsa_result[1]
+        # Textbook RSA without padding, same as _RSAobj.encrypt()
+        m = int.from_bytes(msg[::-1], 'big')
+        rs = pow(m, self.ENC_RSA_E, self.ENC_RSA_N)
+        rs = rs.to_bytes((rs.bit_length() + 7) // 8, 'big')
+        rs = codecs.encode(rs, 'hex').decode()
+        self.last_rsa_result = (msg, rs)
+        return rs
+
+    def encrypt_data_batch(self, data_list, enc_key):
+        enc_sec_key = self.rsa_encrypt(enc_key)
+        enc_data_list = []
+        for data in data_list:
+            # Compact separators, same as JSON.stringify() in the web client
+            data = json.dumps(data, separators=(',', ':')).encode()
+            enc_payload = \
+                self.aes_encrypt(
+                    self.aes_encrypt(data, self.ENC_AES_KEY0),
+                    enc_key)
+            enc_data_list.append({
+                b'params': enc_payload,
+                b'encSecKey': enc_sec_key,
+            })
+        return enc_data_list
 
     def encrypt_data(self, data, enc_key):
-        data = json.dumps(data).encode()
-        enc_payload = \
-            self.aes_encrypt(
-                self.aes_encrypt(data, self.ENC_AES_KEY0),
-                enc_key)
-        enc_key = self.rsa_encrypt(enc_key)
-        enc_data = {
-            b'params': enc_payload,
-            b'encSecKey': enc_key,
-        }
-        return enc_data
+        return self.encrypt_data_batch([data], enc_key)[0]
 
     def _look_for_csrf_token(self, cookie_jar):
         for c in cookie_jar:
-            if c.name == '__csrf' and c.domain.endswith(MUSIC_163_DOMAIN):
+            if c.name == '__csrf' and c.domain.endswith(MUSIC_163_HOST):
                 return c.value
         return None
 
@@ -266,7 +321,7 @@ class Music163API:
                     'Failed to decode text as JSON: {}'
                     .format(resp.text))
 
-    def call_encrypted_api(self, api_url, params=None, data=None, csrf=True):
+    def _prepare_encrypted_call(self, params=None, data=None, csrf=True):
         if csrf:
             csrf_token = self._look_for_csrf_token(self.session.cookies)
             if csrf_token is None:
@@ -284,6 +339,11 @@ class Music163API:
         else:
             enc_data = self.encrypt_data(data, enc_key)
 
+        return (real_params, enc_data)
+
+    def call_encrypted_api(self, api_url, params=None, data=None, csrf=True):
+        real_params, enc_data = \
+                self._prepare_encrypted_call(params, data, csrf)
         resp = self.session.post(
                 api_url, params=real_params,
                 data=enc_data, timeout=self.request_timeout)
@@ -296,3 +356,139 @@ class Music163API:
 
     def format_scrobbling_logs(self, logs):
         return json.dumps(logs)
+
+
+# Adapts aiohttp response headers for http.cookiejar
+class _CookieResponse:
+    def __init__(self, headers):
+        self.headers = headers
+
+    def info(self):
+        return self
+
+    def get_all(self, name, default=None):
+        return self.headers.getall(name, default)
+
+
+class AsyncMusic163API(Music163API):
+    CONNECTION_LIMIT = 32
+    KEEPALIVE_TIMEOUT = 60
+
+    def __init__(self, session=None, profile=None, connection_limit=None):
+        super(AsyncMusic163API, self).__init__(session, profile)
+        if connection_limit is None:
+            connection_limit = self.CONNECTION_LIMIT
+        self.connection_limit = connection_limit
+        self.client = None
+
+    @classmethod
+    def from_api(cls, api, **kwargs):
+        async_api = cls(api.session, api.profile, **kwargs)
+        async_api.set_request_timeout(api.request_timeout)
+        async_api.set_enc_key_reuse(api.enc_key_reuse)
+        return async_api
+
+    def get_client(self):
+        # Created lazily, so that the client is bound to the running loop
+        if self.client is None or self.client.closed:
+            import aiohttp
+            connector = aiohttp.TCPConnector(
+                    limit=self.connection_limit,
+                    keepalive_timeout=self.KEEPALIVE_TIMEOUT)
+            # Cookies are kept in self.session.cookies, so that they can
+            # be shared with (and saved by) the blocking API
+            self.client = aiohttp.ClientSession(
+                    connector=connector,
+                    headers=build_api_headers(),
+                    cookie_jar=aiohttp.DummyCookieJar())
+        return self.client
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+
+    def _client_timeout(self):
+        import aiohttp
+        timeout = self.request_timeout
+        if timeout is None:
+            return aiohttp.ClientTimeout()
+        elif isinstance(timeout, tuple):
+            return aiohttp.ClientTimeout(
+                    sock_connect=timeout[0], sock_read=timeout[1])
+        else:
+            return aiohttp.ClientTimeout(total=timeout)
+
+    def _add_cookie_header(self, url, headers):
+        cookie_req = urlrequest.Request(url)
+        self.session.cookies.add_cookie_header(cookie_req)
+        cookie = cookie_req.get_header('Cookie')
+        if cookie is not None:
+            headers['Cookie'] = cookie
+        return cookie_req
+
+    async def request(self, method, url, params=None, data=None):
+        headers = {}
+        cookie_req = self._add_cookie_header(url, headers)
+        if data is not None:
+            data = urlparse.urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        async with self.get_client().request(
+                method, url, params=params, data=data, headers=headers,
+                timeout=self._client_timeout()) as resp:
+            self.session.cookies.extract_cookies(
+                    _CookieResponse(resp.headers), cookie_req)
+            return await resp.text()
+
+    def _decode_json(self, text):
+        try:
+            return json.loads(text)
+        except:
+            raise APIError(
+                    'Failed to decode text as JSON: {}'
+                    .format(text))
+
+    async def call_api(self, api_url, params=None):
+        if params is None:
+            params = {}
+        text = await self.request('GET', api_url, params=params)
+        return self._decode_json(text)
+
+    async def stream(self, url, consume, headers=None, chunk_size=64*1024):
+        # consume() gets the body chunk by chunk as it arrives, but only
+        # for 200 responses
+        headers = dict(headers or {})
+        cookie_req = self._add_cookie_header(url, headers)
+        async with self.get_client().get(
+                url, headers=headers,
+                timeout=self._client_timeout()) as resp:
+            self.session.cookies.extract_cookies(
+                    _CookieResponse(resp.headers), cookie_req)
+            if resp.status == 200:
+                while True:
+                    chunk = await resp.content.read(chunk_size)
+                    if not chunk:
+                        break
+                    consume(chunk)
+            return (resp.status, resp.reason, resp.headers)
+
+    async def download(self, url, out_file, chunk_size=64*1024):
+        digest = hashlib.md5()
+        async with self.get_client().get(
+                url, timeout=self._client_timeout()) as resp:
+            resp.raise_for_status()
+            while True:
+                chunk = await resp.content.read(chunk_size)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out_file.write(chunk)
+        return digest.hexdigest()
+
+    async def call_encrypted_api(self, api_url, params=None, data=None, csrf=True):
+        real_params, enc_data = \
+                self._prepare_encrypted_call(params, data, csrf)
+        text = await self.request(
+                'POST', api_url, params=real_params, data=enc_data)
+        return self._decode_json(text)
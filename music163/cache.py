@@ -0,0 +1,302 @@
+import os
+import re
+import time
+import json
+import tempfile
+import collections
+
+
+class UrlCache:
+    MAX_ENTRIES = 4096
+    # Used when the server doesn't tell us when an URL expires
+    DEFAULT_EXPIRY = 1200
+    # Consider URLs expired a little earlier than the server says, so that
+    # they don't expire in the middle of a LOAD
+    EXPIRY_MARGIN = 60
+
+    def __init__(self, max_entries=None):
+        if max_entries is None:
+            max_entries = self.MAX_ENTRIES
+        self.max_entries = max_entries
+        # (song_id, bit_rate) -> (expire_time, url_info)
+        self.entries = collections.OrderedDict()
+        self.filename = None
+
+    def set_filename(self, filename):
+        self.filename = filename
+
+    def save(self):
+        self.prune()
+        entries = [[k[0], k[1], v[0], v[1]] for k, v in self.entries.items()]
+        tmp_filename = '{}.tmp'.format(self.filename)
+        with open(tmp_filename, 'w') as out_file:
+            json.dump(entries, out_file)
+        os.replace(tmp_filename, self.filename)
+
+    def load(self):
+        with open(self.filename, 'r') as in_file:
+            entries = json.load(in_file)
+        for song_id, br, expire_time, url_info in entries:
+            self.entries[(song_id, br)] = (expire_time, url_info)
+        self.prune()
+
+    def prune(self):
+        now = time.time()
+        expired = [k for k, v in self.entries.items() if v[0] <= now]
+        for k in expired:
+            del self.entries[k]
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, song_id, br):
+        key = (int(song_id), int(br))
+        entry = self.entries.get(key, None)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def get_many(self, song_ids, br):
+        found = {}
+        missing = []
+        for sid in song_ids:
+            url_info = self.get(sid, br)
+            if url_info is None:
+                missing.append(sid)
+            else:
+                found[sid] = url_info
+        return (found, missing)
+
+    def put_many(self, url_info_list, br):
+        now = time.time()
+        br = int(br)
+        for u in url_info_list:
+            if u.get('url') is None:
+                continue
+            expiry = u.get('expi') or self.DEFAULT_EXPIRY
+            expire_time = now + expiry - self.EXPIRY_MARGIN
+            key = (int(u['id']), br)
+            self.entries[key] = (expire_time, u)
+            self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+class PageCache:
+    # Links extracted from web pages, with the ETag and Last-Modified
+    # headers to revalidate them
+    MAX_ENTRIES = 256
+
+    def __init__(self, max_entries=None):
+        if max_entries is None:
+            max_entries = self.MAX_ENTRIES
+        self.max_entries = max_entries
+        # url -> entry, least recently used first
+        self.entries = collections.OrderedDict()
+        self.filename = None
+
+    def set_filename(self, filename):
+        self.filename = filename
+
+    def save(self):
+        tmp_filename = '{}.tmp'.format(self.filename)
+        with open(tmp_filename, 'w') as out_file:
+            json.dump(list(self.entries.items()), out_file)
+        os.replace(tmp_filename, self.filename)
+
+    def load(self):
+        with open(self.filename, 'r') as in_file:
+            entries = json.load(in_file)
+        for url, entry in entries:
+            self.entries[url] = entry
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, url):
+        entry = self.entries.get(url, None)
+        if entry is not None:
+            self.entries.move_to_end(url)
+        return entry
+
+    def put(self, url, links, etag=None, last_modified=None):
+        if etag is None and last_modified is None:
+            # No way to revalidate it, so it's no use keeping it
+            self.entries.pop(url, None)
+            return
+        self.entries[url] = {
+            'etag': etag,
+            'last_modified': last_modified,
+            'links': links,
+        }
+        self.entries.move_to_end(url)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+class ResultCache:
+    # API results kept in memory for a short while, so that asking the
+    # same thing again doesn't need another round-trip
+    MAX_ENTRIES = 256
+    DEFAULT_TTL = 300
+
+    def __init__(self, max_entries=None, ttl=None):
+        if max_entries is None:
+            max_entries = self.MAX_ENTRIES
+        if ttl is None:
+            ttl = self.DEFAULT_TTL
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # key -> (expire_time, result), least recently used first
+        self.entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.get(key, None)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, result, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        self.entries[key] = (time.time() + ttl, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class AudioCache:
+    MAX_BYTES = 1024 * 1024 * 1024
+    INDEX_FILE = 'index.json'
+    TEMP_SUFFIX = '.part'
+    ENTRY_NAME_RE = re.compile(r'^[0-9]+-[0-9]+$')
+    # Temp files older than this are leftovers from interrupted downloads
+    STALE_TEMP_AGE = 60 * 60
+
+    def __init__(self, path, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = self.MAX_BYTES
+        self.max_bytes = max_bytes
+        self.path = path
+        # file name -> size, least recently used first
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+
+    def _index_filename(self):
+        return os.path.join(self.path, self.INDEX_FILE)
+
+    def _entry_name(self, song_id, br):
+        return '{}-{}'.format(int(song_id), int(br))
+
+    def save(self):
+        index_filename = self._index_filename()
+        tmp_filename = '{}.tmp'.format(index_filename)
+        with open(tmp_filename, 'w') as out_file:
+            json.dump(list(self.entries.items()), out_file)
+        os.replace(tmp_filename, index_filename)
+
+    def load(self):
+        if not os.path.isdir(self.path):
+            os.mkdir(self.path)
+        now = time.time()
+        for f in os.listdir(self.path):
+            f = os.path.join(self.path, f)
+            if f.endswith(self.TEMP_SUFFIX) and \
+                    now - os.path.getmtime(f) > self.STALE_TEMP_AGE:
+                self.discard(f)
+        try:
+            with open(self._index_filename(), 'r') as in_file:
+                entries = json.load(in_file)
+        except (FileNotFoundError, ValueError):
+            entries = []
+        indexed = collections.OrderedDict()
+        for name, size in entries:
+            if os.path.isfile(os.path.join(self.path, name)):
+                indexed[name] = size
+
+        # Files committed without getting into the index, e.g. when the
+        # player crashed right after a download. They go first in line
+        # for eviction, oldest first.
+        untracked = []
+        for name in os.listdir(self.path):
+            if self.ENTRY_NAME_RE.match(name) and name not in indexed:
+                filename = os.path.join(self.path, name)
+                untracked.append(
+                        (os.path.getmtime(filename), name,
+                         os.path.getsize(filename)))
+        untracked.sort()
+
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        for _mtime, name, size in untracked:
+            self.entries[name] = size
+            self.total_bytes += size
+        for name, size in indexed.items():
+            self.entries[name] = size
+            self.total_bytes += size
+        if untracked:
+            self.evict()
+            self.save()
+
+    def get(self, song_id, br):
+        name = self._entry_name(song_id, br)
+        if name not in self.entries:
+            return None
+        filename = os.path.join(self.path, name)
+        if not os.path.isfile(filename):
+            self.total_bytes -= self.entries.pop(name)
+            return None
+        self.entries.move_to_end(name)
+        return filename
+
+    def open_temp(self):
+        if not os.path.isdir(self.path):
+            os.mkdir(self.path)
+        fd, tmp_filename = tempfile.mkstemp(
+                suffix=self.TEMP_SUFFIX, dir=self.path)
+        return (os.fdopen(fd, 'wb'), tmp_filename)
+
+    def discard(self, tmp_filename):
+        try:
+            os.remove(tmp_filename)
+        except FileNotFoundError:
+            pass
+
+    def commit(self, song_id, br, tmp_filename):
+        size = os.path.getsize(tmp_filename)
+        if size > self.max_bytes:
+            self.discard(tmp_filename)
+            return None
+
+        name = self._entry_name(song_id, br)
+        filename = os.path.join(self.path, name)
+        # Atomic, so that readers never see a partial file
+        os.replace(tmp_filename, filename)
+        if name in self.entries:
+            self.total_bytes -= self.entries.pop(name)
+        self.entries[name] = size
+        self.total_bytes += size
+        self.evict()
+        self.save()
+        return filename
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            name, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
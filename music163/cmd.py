@@ -1,24 +1,24 @@
 import sys
 import os
-import io
-import re
-import asyncio
 import hashlib
 import json
-import urllib.parse as urlparse
-
-from lxml import etree
-from .api import (MUSIC_163_SCHEME, MUSIC_163_DOMAIN)
-from .playlist import (DEFAULT_PLAYLIST_FORMAT, generate_playlist)
-from .player import Mpg123
-from .lastfm import (LastFMAPI, lastfm_login)
+# Everything else is imported by the commands that need it, so that
+# e.g. 'music163 refresh' doesn't have to load the player, aiohttp, lxml
+# and friends
 
 
 DEFAULT_BIT_RATE = 320000
+SONG_DETAIL_BATCH_SIZE = 200
 RES_PATH = os.path.join(os.path.expanduser('~'), '.music163')
 COOKIES_FILE = os.path.join(RES_PATH, 'cookies.txt')
 PROFILE_FILE = os.path.join(RES_PATH, 'profile.json')
 LASTFM_INFO_FILE = os.path.join(RES_PATH, 'lastfm.json')
+URL_CACHE_FILE = os.path.join(RES_PATH, 'urls.json')
+PAGE_CACHE_FILE = os.path.join(RES_PATH, 'pages.json')
+METADATA_FILE = os.path.join(RES_PATH, 'metadata.db')
+AUDIO_CACHE_PATH = os.path.join(RES_PATH, 'audio')
+WEBLOG_JOURNAL_FILE = os.path.join(RES_PATH, 'weblog.journal')
+LASTFM_JOURNAL_FILE = os.path.join(RES_PATH, 'lastfm.journal')
 
 
 class InvalidCmdError(Exception):
@@ -41,6 +41,8 @@ def cmd_login(api, argv):
     for field in ['userId', 'nickname']:
         api.profile[field] = r['profile'][field]
         api.profile[field] = r['profile'][field]
+    # May belong to another account
+    api.profile.pop('likedPlaylistId', None)
     api.profile.save()
 
     print('Done.')
@@ -56,13 +58,21 @@ def cmd_refresh(api, argv):
 
 
 def cmd_play_playlist(api, argv):
+    from .store import MetadataStore
+
     playlist_id = int(argv.pop(0))
-    r = api.playlist_detail(playlist_id)
-    if r['code'] != 200:
-        print(r, file=sys.stderr)
-        raise FailedCmdError('play playlist {}'.format(playlist_id))
+    store = MetadataStore(METADATA_FILE)
+    playlist = store.get('playlist', playlist_id)
+    if playlist is None:
+        r = api.playlist_detail(playlist_id)
+        if r['code'] != 200:
+            print(r, file=sys.stderr)
+            raise FailedCmdError('play playlist {}'.format(playlist_id))
+        playlist = r['result']
+        store.put('playlist', playlist_id, playlist, playlist.get('updateTime'))
+    store.close()
 
-    _cmd_generate_playlist(argv, api, r['result']['tracks'])
+    _cmd_generate_playlist(argv, api, playlist['tracks'])
 
 
 def cmd_play_song(api, argv):
@@ -75,49 +85,72 @@ def cmd_play_song(api, argv):
             break
         song_ids.append(sid)
 
-    r = api.song_detail(song_ids)
-    if r['code'] != 200:
-        print(r, file=sys.stderr)
-        raise FailedCmdError('play song {}'.format(song_ids))
-
-    _cmd_generate_playlist(argv, api, r['songs'])
+    song_list = _fetch_song_details(
+            api, song_ids, 'play song {}'.format(song_ids))
+    _cmd_generate_playlist(argv, api, song_list)
 
 
 def cmd_play_page(api, argv):
-    page_url = argv.pop(0)
-    u = urlparse.urlparse(page_url)
-    if not u.scheme:
-        scheme = MUSIC_163_SCHEME
-    else:
-        scheme = u.scheme
-    if not u.netloc:
-        netloc = MUSIC_163_DOMAIN
-    else:
-        netloc = u.netloc
-
-    page_url = urlparse.urlunparse((
-        scheme, netloc, u.path, u.params, u.query, u.fragment))
-
-    r = api.session.get(page_url)
-    doc = etree.parse(io.StringIO(r.text), etree.HTMLParser())
+    from .page import (PageError, normalize_page_url, fetch_page_links)
 
-    song_ids = []
-    song_pattern = re.compile('^.*/song/?\?id\=([0-9]+)$')
-    for a in doc.iter('a'):
-        href = a.attrib.get('href')
-        if not href:
-            continue
-        m = song_pattern.match(href)
-        if m is None:
-            continue
-        song_ids.append(int(m.group(1)))
-
-    r = api.song_detail(song_ids)
-    if r['code'] != 200:
-        print(r, file=sys.stderr)
-        raise FailedCmdError('play page {}'.format(page_url))
+    page_url = normalize_page_url(argv.pop(0))
 
-    _cmd_generate_playlist(argv, api, r['songs'])
+    page_cache = _load_page_cache()
+    try:
+        links = fetch_page_links(api.session, page_url, page_cache)
+    except PageError as e:
+        print(e, file=sys.stderr)
+        raise FailedCmdError('play page {}'.format(page_url))
+    page_cache.save()
+
+    song_list = _fetch_song_details(
+            api, links.song_ids, 'play page {}'.format(page_url))
+    _cmd_generate_playlist(argv, api, song_list)
+
+
+def cmd_play_pages(api, argv):
+    import asyncio
+    from .api import AsyncMusic163API
+    from .playlist import get_playlist_formats
+    from .page import (normalize_page_url, async_fetch_pages_links,
+            make_parse_executor)
+
+    # Everything before the playlist format is a page URL
+    formats = get_playlist_formats()
+    page_urls = []
+    while len(argv) > 0 and argv[0] not in formats:
+        page_url = normalize_page_url(argv.pop(0))
+        if page_url not in page_urls:
+            page_urls.append(page_url)
+    if len(page_urls) == 0:
+        raise InvalidCmdError('play pages')
+
+    page_cache = _load_page_cache()
+    async_api = AsyncMusic163API.from_api(api)
+    loop = asyncio.new_event_loop()
+    try:
+        with make_parse_executor(
+                max_workers=min(len(page_urls), os.cpu_count() or 1)) \
+                as executor:
+            links, errors = loop.run_until_complete(
+                    async_fetch_pages_links(
+                        async_api, page_urls, page_cache, executor))
+        page_cache.save()
+
+        for page_url, e in errors:
+            print('Warning: Failed to fetch page {}: {}'.format(page_url, e),
+                    file=sys.stderr)
+        if len(errors) == len(page_urls):
+            raise FailedCmdError('play pages')
+
+        song_list = loop.run_until_complete(
+                _async_fetch_song_details(
+                    async_api, links.song_ids, 'play pages'))
+    finally:
+        loop.run_until_complete(async_api.close())
+        loop.close()
+
+    _cmd_generate_playlist(argv, api, song_list)
 
 
 def cmd_play_radio(api, argv):
@@ -144,6 +177,12 @@ def cmd_play_recommended(api, argv):
 
 
 def cmd_player(api, argv):
+    import asyncio
+    from .player import Mpg123
+    from .cache import AudioCache
+    from .store import MetadataStore
+    from .lastfm import LastFMAPI
+
     try:
         binary = argv.pop(0)
     except IndexError:
@@ -155,20 +194,119 @@ def cmd_player(api, argv):
         lastfm_api.credentials['sk'] = lastfm_info['sk']
     except FileNotFoundError:
         lastfm_api = None
-    player = Mpg123(api=api, lastfm_api=lastfm_api, binary=binary, extra_args=argv)
+    url_cache = _load_url_cache()
+    page_cache = _load_page_cache()
+    store = MetadataStore(METADATA_FILE)
+    audio_cache = AudioCache(AUDIO_CACHE_PATH)
+    try:
+        audio_cache.load()
+    except (FileNotFoundError, ValueError):
+        pass
+    weblog_journal = _load_journal(WEBLOG_JOURNAL_FILE)
+    lastfm_journal = _load_journal(LASTFM_JOURNAL_FILE)
+    player = Mpg123(api=api, lastfm_api=lastfm_api, binary=binary,
+            extra_args=argv, url_cache=url_cache, metadata_store=store,
+            audio_cache=audio_cache, weblog_journal=weblog_journal,
+            lastfm_journal=lastfm_journal, page_cache=page_cache)
     loop = asyncio.get_event_loop()
     loop.run_until_complete(player.run())
     loop.close()
+    url_cache.save()
+    page_cache.save()
+    # Songs played from the cache have moved up in the LRU order
+    audio_cache.save()
+    store.close()
+
+
+def _load_journal(filename):
+    from .journal import Journal
+
+    journal = Journal()
+    journal.set_filename(filename)
+    try:
+        journal.load()
+    except FileNotFoundError:
+        pass
+    return journal
 
 
 def cmd_lastfm_login(api, argv):
+    from .lastfm import lastfm_login
+
     api_key = argv.pop(0)
     shared_secret = argv.pop(0)
     lastfm_login(api_key, shared_secret, LASTFM_INFO_FILE)
     print('Done.')
 
 
+def _fetch_song_details(api, song_ids, cmd_desc):
+    from .store import MetadataStore
+
+    store = MetadataStore(METADATA_FILE)
+    found, missing = store.get_many('song', song_ids)
+    for n in range(0, len(missing), SONG_DETAIL_BATCH_SIZE):
+        r = api.song_detail(missing[n:n+SONG_DETAIL_BATCH_SIZE])
+        if r['code'] != 200:
+            print(r, file=sys.stderr)
+            raise FailedCmdError(cmd_desc)
+        store.put_songs(r['songs'])
+        for s in r['songs']:
+            found[s['id']] = s
+    store.close()
+    return [found[sid] for sid in song_ids if sid in found]
+
+
+async def _async_fetch_song_details(async_api, song_ids, cmd_desc):
+    # Same as _fetch_song_details(), but with all batches sent at once
+    import asyncio
+    from .store import MetadataStore
+
+    store = MetadataStore(METADATA_FILE)
+    try:
+        found, missing = store.get_many('song', song_ids)
+        responses = await asyncio.gather(
+                *[async_api.song_detail(missing[n:n+SONG_DETAIL_BATCH_SIZE])
+                  for n in range(0, len(missing), SONG_DETAIL_BATCH_SIZE)])
+        for r in responses:
+            if r['code'] != 200:
+                print(r, file=sys.stderr)
+                raise FailedCmdError(cmd_desc)
+            store.put_songs(r['songs'])
+            for s in r['songs']:
+                found[s['id']] = s
+    finally:
+        store.close()
+    return [found[sid] for sid in song_ids if sid in found]
+
+
+def _load_url_cache():
+    from .cache import UrlCache
+
+    url_cache = UrlCache()
+    url_cache.set_filename(URL_CACHE_FILE)
+    try:
+        url_cache.load()
+    except (FileNotFoundError, ValueError):
+        pass
+    return url_cache
+
+
+def _load_page_cache():
+    from .cache import PageCache
+
+    page_cache = PageCache()
+    page_cache.set_filename(PAGE_CACHE_FILE)
+    try:
+        page_cache.load()
+    except (FileNotFoundError, ValueError):
+        pass
+    return page_cache
+
+
 def _cmd_generate_playlist(argv, api, song_list):
+    from .playlist import (DEFAULT_PLAYLIST_FORMAT,
+            DEFAULT_FETCH_CONCURRENCY, generate_playlist)
+
     pl_format = DEFAULT_PLAYLIST_FORMAT
     if len(argv) > 0:
         pl_format = argv.pop(0)
@@ -177,7 +315,15 @@ def _cmd_generate_playlist(argv, api, song_list):
     if len(argv) > 0:
         bit_rate = argv.pop(0)
 
-    generate_playlist(pl_format, bit_rate, api, song_list, sys.stdout)
+    concurrency = DEFAULT_FETCH_CONCURRENCY
+    if len(argv) > 0:
+        concurrency = int(argv.pop(0))
+
+    url_cache = _load_url_cache()
+    generate_playlist(
+            pl_format, bit_rate, api, song_list, sys.stdout, url_cache,
+            concurrency)
+    url_cache.save()
 
 
 commands = {
@@ -187,6 +333,7 @@ commands = {
         'playlist': cmd_play_playlist,
         'song':     cmd_play_song,
         'page':     cmd_play_page,
+        'pages':    cmd_play_pages,
         'radio':    cmd_play_radio,
         'recommended': cmd_play_recommended,
     },
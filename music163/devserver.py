@@ -0,0 +1,567 @@
+import sys
+import json
+import time
+import zlib
+import base64
+import random
+import asyncio
+import hashlib
+import argparse
+import binascii
+import collections
+
+from aiohttp import web
+from Crypto.Cipher import AES
+from Crypto.PublicKey import RSA
+
+from .api import Music163API
+
+
+# A stand-in for the /weapi/... endpoints on music.163.com, serving a
+# synthetic catalogue. Point the client at it with the environment
+# variables printed on start-up.
+
+
+class Catalogue:
+    SONG_ID_BASE = 100000
+    ARTIST_ID_BASE = 10000
+    ALBUM_ID_BASE = 20000
+    PLAYLIST_ID_BASE = 300000
+    PROGRAM_ID_BASE = 500000
+    USER_ID = 1
+
+    SONGS_PER_ALBUM = 10
+    SONGS_PER_ARTIST = 25
+    ARTIST_PAGE_SONGS = 50
+    SUGGEST_COUNT = 3
+
+    def __init__(self, n_songs, n_playlists, playlist_size,
+                 stream_size, seed=None):
+        self.n_songs = n_songs
+        self.n_playlists = n_playlists
+        self.playlist_size = min(playlist_size, n_songs)
+        self.stream_size = stream_size
+        self.seed = seed if seed is not None else random.randrange(1 << 30)
+        self.n_artists = max(1, n_songs // self.SONGS_PER_ARTIST)
+        self.n_albums = max(1, n_songs // self.SONGS_PER_ALBUM)
+        self.update_time = int(time.time() * 1000)
+        self.stream_md5 = {}
+
+    def song_index(self, song_id):
+        idx = song_id - self.SONG_ID_BASE
+        if 0 <= idx < self.n_songs:
+            return idx
+        return None
+
+    def artist(self, idx):
+        return {
+            'id': self.ARTIST_ID_BASE + idx,
+            'name': 'Artist {}'.format(idx),
+            'trans': '',
+        }
+
+    def album(self, idx):
+        artist_idx = (idx * self.SONGS_PER_ALBUM // self.SONGS_PER_ARTIST) \
+                % self.n_artists
+        return {
+            'id': self.ALBUM_ID_BASE + idx,
+            'name': 'Album {}'.format(idx),
+            'type': 'Album',
+            'subType': '',
+            'artist': self.artist(artist_idx),
+            'artists': [self.artist(artist_idx)],
+        }
+
+    def song(self, idx, new_format=False):
+        artist = self.artist((idx // self.SONGS_PER_ARTIST) % self.n_artists)
+        album_idx = (idx // self.SONGS_PER_ALBUM) % self.n_albums
+        album = {
+            'id': self.ALBUM_ID_BASE + album_idx,
+            'name': 'Album {}'.format(album_idx),
+        }
+        duration = 120000 + (idx * 7919) % 240000
+        if new_format:
+            # Field names used by the newer APIs, e.g. the v3 playlist
+            # detail
+            return {
+                'id': self.SONG_ID_BASE + idx,
+                'name': 'Song {}'.format(idx),
+                'dt': duration,
+                'ar': [artist],
+                'al': album,
+            }
+        return {
+            'id': self.SONG_ID_BASE + idx,
+            'name': 'Song {}'.format(idx),
+            'duration': duration,
+            'artists': [artist],
+            'album': album,
+        }
+
+    def songs(self, song_ids, new_format=False):
+        songs = []
+        for sid in song_ids:
+            idx = self.song_index(sid)
+            if idx is not None:
+                songs.append(self.song(idx, new_format))
+        return songs
+
+    def random_songs(self, count):
+        rand = random.Random()
+        return [self.song(rand.randrange(self.n_songs)) for _ in range(count)]
+
+    def playlist_index(self, pl_id):
+        idx = pl_id - self.PLAYLIST_ID_BASE
+        if 0 <= idx < self.n_playlists:
+            return idx
+        return None
+
+    def playlist_track_ids(self, idx):
+        rand = random.Random(self.seed + idx)
+        song_idx = rand.sample(range(self.n_songs), self.playlist_size)
+        return [self.SONG_ID_BASE + i for i in song_idx]
+
+    def playlist(self, idx, with_tracks=True):
+        pl = {
+            'id': self.PLAYLIST_ID_BASE + idx,
+            'name': 'Playlist {}'.format(idx),
+            'trackCount': self.playlist_size,
+            'updateTime': self.update_time,
+            # The first playlist plays the part of "liked songs"
+            'specialType': 5 if idx == 0 else 0,
+            'creator': {'userId': self.USER_ID, 'nickname': 'tester'},
+        }
+        if with_tracks:
+            pl['tracks'] = self.songs(self.playlist_track_ids(idx))
+        return pl
+
+    def program(self, program_id):
+        idx = program_id - self.PROGRAM_ID_BASE
+        if not (0 <= idx < self.n_songs):
+            return None
+        return {
+            'id': program_id,
+            'name': 'Program {}'.format(idx),
+            'mainSong': self.song(idx),
+            'dj': {'brand': 'Radio {}'.format(idx % 100), 'nickname': 'DJ'},
+        }
+
+    def stream(self, song_id):
+        block = '{:<16}'.format(song_id).encode()
+        content = block * (self.stream_size // len(block) + 1)
+        return content[:self.stream_size]
+
+    def get_stream_md5(self, song_id):
+        md5 = self.stream_md5.get(song_id)
+        if md5 is None:
+            md5 = hashlib.md5(self.stream(song_id)).hexdigest()
+            self.stream_md5[song_id] = md5
+        return md5
+
+    def search_range(self, query, total):
+        # Stable, made-up results: the query decides how many items match
+        # and where they start in the catalogue
+        h = zlib.crc32(query.encode())
+        count = h % (total + 1)
+        start = (h >> 8) % max(total, 1)
+        return (count, start)
+
+    def search(self, query, search_type, limit, offset):
+        search_type = int(search_type)
+        if search_type == 1:
+            total, make, key = (self.n_songs, self.song, 'songs')
+        elif search_type == 10:
+            total, make, key = (self.n_albums, self.album, 'albums')
+        elif search_type == 100:
+            total, make, key = (self.n_artists, self.artist, 'artists')
+        elif search_type == 1000:
+            total, key = (self.n_playlists, 'playlists')
+            make = lambda i: self.playlist(i, with_tracks=False)
+        elif search_type == 1009:
+            total, key = (self.n_songs, 'djprograms')
+            make = lambda i: self.program(self.PROGRAM_ID_BASE + i)
+        elif search_type == 1002:
+            total, key = (1000, 'userprofiles')
+            make = lambda i: {
+                'userId': self.USER_ID + i,
+                'nickname': 'User {}'.format(i),
+                'signature': '',
+            }
+        else:
+            return None
+
+        count, start = self.search_range(query, total)
+        items = []
+        for i in range(offset, min(offset + limit, count)):
+            items.append(make((start + i) % total))
+        count_key = key[:-1] + 'Count'
+        return {count_key: count, key: items}
+
+    def suggest(self, query):
+        count, start = self.search_range(query, self.n_songs)
+        if count == 0:
+            return {}
+        n = self.SUGGEST_COUNT
+        songs = [self.song((start + i) % self.n_songs) for i in range(n)]
+        return {
+            'order': ['songs', 'artists', 'albums', 'playlists'],
+            'songs': songs,
+            'artists': [self.artist((start + i) % self.n_artists)
+                        for i in range(n)],
+            'albums': [self.album((start + i) % self.n_albums)
+                       for i in range(n)],
+            'playlists': [self.playlist((start + i) % self.n_playlists,
+                                        with_tracks=False)
+                          for i in range(n)],
+        }
+
+
+class DevServer:
+    MAX_USER_PLAYLIST_LIMIT = 1000
+    COOKIE_MAX_AGE = 15 * 24 * 3600
+
+    def __init__(self, catalogue, rsa_key, host,
+                 latency=0, jitter=0, error_rate=0, api_error_rate=0):
+        self.catalogue = catalogue
+        self.host = host
+        self.rsa_key = rsa_key
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.api_error_rate = api_error_rate
+        self.stats = collections.Counter()
+        self.rand = random.Random()
+
+    def make_app(self):
+        app = web.Application()
+        api_handlers = [
+            ('/weapi/login/cellphone', self.login, False),
+            ('/weapi/login/token/refresh', self.refresh, True),
+            ('/weapi/playlist/detail', self.playlist_detail, True),
+            ('/weapi/v3/playlist/detail', self.playlist_detail_v3, True),
+            ('/weapi/song/detail', self.song_detail, True),
+            ('/weapi/radio/get', self.personal_fm, True),
+            ('/weapi/v1/discovery/recommend/songs',
+                self.discovery_recommend_songs, True),
+            ('/weapi/song/enhance/player/url',
+                self.song_enhance_player_url, True),
+            ('/weapi/dj/program/detail', self.dj_program_detail, True),
+            ('/weapi/user/playlist', self.user_playlist, True),
+            ('/weapi/playlist/manipulate/tracks',
+                self.playlist_manipulate_tracks, True),
+            ('/weapi/cloudsearch/get/web', self.cloudsearch_get_web, True),
+            ('/weapi/search/suggest/web', self.search_suggest_web, True),
+            ('/weapi/playlist/create', self.playlist_create, True),
+            ('/weapi/playlist/delete', self.playlist_delete, True),
+            ('/weapi/feedback/weblog', self.feedback_weblog, True),
+        ]
+        for path, handler, csrf in api_handlers:
+            app.router.add_post(path, self.wrap_api(handler, csrf))
+
+        app.router.add_get('/stream/{song_id:[0-9]+}-{br:[0-9]+}.mp3',
+                           self.wrap(self.stream))
+        app.router.add_get('/playlist', self.wrap(self.playlist_page))
+        app.router.add_get('/album', self.wrap(self.album_page))
+        app.router.add_get('/artist', self.wrap(self.artist_page))
+        app.router.add_get('/discover/toplist', self.wrap(self.playlist_page))
+        app.router.add_get('/_stats', self.get_stats)
+        return app
+
+    def aes_decrypt(self, ciphertext, key):
+        decryptor = AES.new(key, AES.MODE_CBC, Music163API.ENC_AES_IV)
+        msg = decryptor.decrypt(base64.b64decode(ciphertext))
+        return msg[:-msg[-1]]
+
+    def decrypt_data(self, params, enc_sec_key):
+        # Reverses Music163API.encrypt_data()
+        m = pow(int(enc_sec_key, 16), self.rsa_key.d, self.rsa_key.n)
+        enc_key = m.to_bytes(16, 'big')[::-1]
+        data = self.aes_decrypt(
+                self.aes_decrypt(params, enc_key),
+                Music163API.ENC_AES_KEY0)
+        return json.loads(data.decode())
+
+    async def delay(self):
+        t = self.latency + self.rand.uniform(0, self.jitter)
+        if t > 0:
+            await asyncio.sleep(t)
+
+    def wrap(self, handler):
+        async def wrapped(request):
+            self.stats[request.path] += 1
+            await self.delay()
+            if self.rand.random() < self.error_rate:
+                self.stats['injected_errors'] += 1
+                return web.Response(status=503, text='Service Unavailable')
+            return await handler(request)
+        return wrapped
+
+    def wrap_api(self, handler, csrf):
+        async def api_handler(request):
+            form = await request.post()
+            try:
+                data = self.decrypt_data(form['params'], form['encSecKey'])
+            except (KeyError, ValueError, TypeError, binascii.Error):
+                return web.json_response({'code': 400, 'msg': 'Bad params'})
+
+            if csrf:
+                token = request.cookies.get('__csrf')
+                if token is None or \
+                        request.query.get('csrf_token') != token:
+                    return web.json_response(
+                            {'code': 301, 'msg': 'Not logged in'})
+
+            if self.rand.random() < self.api_error_rate:
+                self.stats['injected_api_errors'] += 1
+                return web.json_response({'code': -460, 'msg': 'Cheating'})
+
+            try:
+                r = handler(data)
+            except (KeyError, ValueError, TypeError):
+                return web.json_response({'code': 400, 'msg': 'Bad params'})
+            if isinstance(r, web.StreamResponse):
+                return r
+            r.setdefault('code', 200)
+            return web.json_response(r)
+        return self.wrap(api_handler)
+
+    async def get_stats(self, request):
+        return web.json_response(dict(self.stats))
+
+    def login(self, data):
+        resp = web.json_response({
+            'code': 200,
+            'profile': {
+                'userId': self.catalogue.USER_ID,
+                'nickname': 'tester',
+            },
+        })
+        token = hashlib.md5(
+                '{}:{}'.format(data['phone'], time.time()).encode()).hexdigest()
+        # Session cookies would not be saved by the client
+        resp.set_cookie('__csrf', token, path='/', max_age=self.COOKIE_MAX_AGE)
+        resp.set_cookie('MUSIC_U', token, path='/', max_age=self.COOKIE_MAX_AGE)
+        return resp
+
+    def refresh(self, data):
+        return {}
+
+    def playlist_detail(self, data):
+        idx = self.catalogue.playlist_index(int(data['id']))
+        if idx is None:
+            return {'code': 404, 'msg': 'No such playlist'}
+        return {'result': self.catalogue.playlist(idx)}
+
+    def playlist_detail_v3(self, data):
+        idx = self.catalogue.playlist_index(int(data['id']))
+        if idx is None:
+            return {'code': 404, 'msg': 'No such playlist'}
+        playlist = self.catalogue.playlist(idx, with_tracks=False)
+        track_ids = self.catalogue.playlist_track_ids(idx)
+        playlist['trackIds'] = [{'id': sid, 'v': 1} for sid in track_ids]
+        playlist['tracks'] = \
+                self.catalogue.songs(
+                        track_ids[:int(data.get('n', 1000))], new_format=True)
+        return {'playlist': playlist}
+
+    def parse_ids(self, ids):
+        # The ID list can be sent either as a JSON string or an array
+        if isinstance(ids, str):
+            ids = json.loads(ids)
+        return [int(i) for i in ids]
+
+    def song_detail(self, data):
+        return {'songs': self.catalogue.songs(self.parse_ids(data['ids']))}
+
+    def personal_fm(self, data):
+        return {'data': self.catalogue.random_songs(3)}
+
+    def discovery_recommend_songs(self, data):
+        return {'recommend': self.catalogue.random_songs(30)}
+
+    def song_enhance_player_url(self, data):
+        br = int(data['br'])
+        url_info_list = []
+        for sid in self.parse_ids(data['ids']):
+            if self.catalogue.song_index(sid) is None:
+                url_info_list.append({'id': sid, 'url': None, 'code': 404})
+                continue
+            url_info_list.append({
+                'id': sid,
+                'url': 'http://{}/stream/{}-{}.mp3'.format(
+                    self.host, sid, br),
+                'br': br,
+                'size': self.catalogue.stream_size,
+                'md5': self.catalogue.get_stream_md5(sid),
+                'code': 200,
+                'expi': 1200,
+                'type': 'mp3',
+            })
+        return {'data': url_info_list}
+
+    def dj_program_detail(self, data):
+        program = self.catalogue.program(int(data['id']))
+        if program is None:
+            return {'code': 404, 'msg': 'No such program'}
+        return {'program': program}
+
+    def user_playlist(self, data):
+        offset = int(data['offset'])
+        limit = min(int(data['limit']), self.MAX_USER_PLAYLIST_LIMIT)
+        n = self.catalogue.n_playlists
+        pl_list = [self.catalogue.playlist(i, with_tracks=False)
+                   for i in range(offset, min(offset + limit, n))]
+        return {'playlist': pl_list, 'more': offset + limit < n}
+
+    def playlist_manipulate_tracks(self, data):
+        return {}
+
+    def cloudsearch_get_web(self, data):
+        result = self.catalogue.search(
+                data['s'], data['type'],
+                int(data['limit']), int(data['offset']))
+        if result is None:
+            return {'code': 400, 'msg': 'Unknown search type'}
+        return {'result': result}
+
+    def search_suggest_web(self, data):
+        return {'result': self.catalogue.suggest(data['s'])}
+
+    def playlist_create(self, data):
+        return {'id': self.catalogue.PLAYLIST_ID_BASE + self.catalogue.n_playlists}
+
+    def playlist_delete(self, data):
+        return {'id': int(data['pid'])}
+
+    def feedback_weblog(self, data):
+        self.stats['weblog_entries'] += len(json.loads(data['logs']))
+        return {}
+
+    async def stream(self, request):
+        song_id = int(request.match_info['song_id'])
+        if self.catalogue.song_index(song_id) is None:
+            return web.Response(status=404)
+        return web.Response(body=self.catalogue.stream(song_id),
+                            content_type='audio/mpeg')
+
+    def render_page(self, request, title, song_ids):
+        # The content never changes, so the catalogue's update time can
+        # tell whether it's still fresh
+        etag = '"{:x}-{:x}"'.format(
+                zlib.crc32(request.path_qs.encode()), self.catalogue.update_time)
+        headers = {'ETag': etag}
+        if request.headers.get('If-None-Match') == etag:
+            self.stats['page_not_modified'] += 1
+            return web.Response(status=304, headers=headers)
+        links = ''.join(
+                ['<li><a href="/song?id={}">Song</a></li>'.format(sid)
+                 for sid in song_ids])
+        return web.Response(
+                text='<!DOCTYPE html><html><head><title>{}</title></head>'
+                     '<body><ul class="f-hide">{}</ul></body></html>'
+                     .format(title, links),
+                content_type='text/html', headers=headers)
+
+    def get_query_id(self, request, default=None):
+        try:
+            return int(request.query['id'])
+        except (KeyError, ValueError):
+            return default
+
+    async def playlist_page(self, request):
+        idx = self.catalogue.playlist_index(
+                self.get_query_id(request, self.catalogue.PLAYLIST_ID_BASE))
+        if idx is None:
+            return web.Response(status=404)
+        return self.render_page(
+                request,
+                'Playlist {}'.format(idx),
+                self.catalogue.playlist_track_ids(idx))
+
+    async def album_page(self, request):
+        idx = self.get_query_id(request, -1) - self.catalogue.ALBUM_ID_BASE
+        if not (0 <= idx < self.catalogue.n_albums):
+            return web.Response(status=404)
+        first = self.catalogue.SONG_ID_BASE + idx * self.catalogue.SONGS_PER_ALBUM
+        return self.render_page(
+                request,
+                'Album {}'.format(idx),
+                range(first, first + self.catalogue.SONGS_PER_ALBUM))
+
+    async def artist_page(self, request):
+        idx = self.get_query_id(request, -1) - self.catalogue.ARTIST_ID_BASE
+        if not (0 <= idx < self.catalogue.n_artists):
+            return web.Response(status=404)
+        first = self.catalogue.SONG_ID_BASE + idx * self.catalogue.SONGS_PER_ARTIST
+        n = min(self.catalogue.SONGS_PER_ARTIST,
+                self.catalogue.ARTIST_PAGE_SONGS)
+        return self.render_page(
+                request,
+                'Artist {}'.format(idx), range(first, first + n))
+
+
+def load_rsa_key(key_file):
+    if key_file is None:
+        return RSA.generate(1024)
+    try:
+        with open(key_file, 'rb') as in_file:
+            return RSA.importKey(in_file.read())
+    except FileNotFoundError:
+        key = RSA.generate(1024)
+        with open(key_file, 'wb') as out_file:
+            out_file.write(key.exportKey())
+        return key
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            prog='python -m music163.devserver',
+            description='Serve a synthetic catalogue through a local '
+                        'stand-in for the music.163.com web API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8163)
+    parser.add_argument('--songs', type=int, default=100000)
+    parser.add_argument('--playlists', type=int, default=100)
+    parser.add_argument('--playlist-size', type=int, default=1000)
+    parser.add_argument('--stream-size', type=int, default=1024 * 1024,
+            help='size of the fake audio streams, in bytes')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--latency', type=float, default=0,
+            help='delay every response by this many seconds')
+    parser.add_argument('--jitter', type=float, default=0,
+            help='add a random delay of up to this many seconds')
+    parser.add_argument('--error-rate', type=float, default=0,
+            help='fraction of requests answered with HTTP 503')
+    parser.add_argument('--api-error-rate', type=float, default=0,
+            help='fraction of API calls answered with an error code')
+    parser.add_argument('--key-file',
+            help='keep the RSA key here, so that it survives restarts')
+    args = parser.parse_args()
+
+    catalogue = Catalogue(
+            args.songs, args.playlists, args.playlist_size,
+            args.stream_size, args.seed)
+    rsa_key = load_rsa_key(args.key_file)
+    server = DevServer(
+            catalogue, rsa_key, '{}:{}'.format(args.host, args.port),
+            latency=args.latency, jitter=args.jitter,
+            error_rate=args.error_rate, api_error_rate=args.api_error_rate)
+
+    print('export MUSIC_163_SCHEME=http')
+    print('export MUSIC_163_DOMAIN={}'.format(server.host))
+    print('export MUSIC_163_RSA_MODULUS={:x}'.format(rsa_key.n))
+    print('# Log in with any phone number and password. Consider using a '
+          'separate $HOME, so that the real cookies are not overwritten.',
+          file=sys.stderr)
+    print('# Playlist IDs: {} - {}'.format(
+              catalogue.PLAYLIST_ID_BASE,
+              catalogue.PLAYLIST_ID_BASE + catalogue.n_playlists - 1),
+          file=sys.stderr)
+    sys.stdout.flush()
+
+    web.run_app(server.make_app(), host=args.host, port=args.port,
+                print=None)
+
+
+if __name__ == '__main__':
+    main()
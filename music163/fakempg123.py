@@ -0,0 +1,206 @@
+import os
+import sys
+import asyncio
+import argparse
+from asyncio import streams
+
+
+# A stand-in for "mpg123 --remote". It decodes nothing, but reports
+# loading, playing and track ends the way mpg123 does, at whatever pace
+# is asked for. Use it in place of the real binary, e.g.
+#
+#     music163 player music163-fakempg123 --frame-rate 0 --track-length 5
+
+
+SAMPLES_PER_FRAME = 1152
+SAMPLE_RATE = 44100
+# Seconds of audio in one MPEG 1 layer III frame at 44.1 kHz
+FRAME_SECONDS = SAMPLES_PER_FRAME / SAMPLE_RATE
+
+
+async def async_stdio(loop=None):
+    if loop is None:
+        loop = asyncio.get_event_loop()
+
+    reader = asyncio.StreamReader()
+    reader_protocol = asyncio.StreamReaderProtocol(reader)
+    await loop.connect_read_pipe(lambda: reader_protocol, sys.stdin)
+
+    writer_transport, writer_protocol = \
+            await loop.connect_write_pipe(
+                    streams.FlowControlMixin, os.fdopen(1, 'wb'))
+    writer = streams.StreamWriter(
+            writer_transport, writer_protocol, None, loop)
+
+    return reader, writer
+
+
+class FakeMpg123:
+    VERSION = 'MPG123 (music163 fake) v10'
+    STREAM_INFO = '1.0 3 44100 Joint-Stereo 0 1044 2 0 0 0 320 0 1'
+
+    def __init__(self, reader, writer, track_length=240,
+                 frame_rate=1 / FRAME_SECONDS, frame_step=1, loop=None):
+        self.reader = reader
+        self.writer = writer
+        self.total_frames = max(1, int(track_length / FRAME_SECONDS))
+        # 0 means sending the frames as fast as possible
+        self.frame_interval = 1 / frame_rate if frame_rate > 0 else 0
+        self.frame_step = frame_step
+        self.loop = loop or asyncio.get_event_loop()
+        self.play_task = None
+        self.frame = 0
+        self.loaded = False
+        # No @F messages after SILENCE
+        self.silent = False
+        self.unpaused = asyncio.Event()
+        self.unpaused.set()
+        self.cmd_handlers = {
+            'LOAD': self.cmd_load,
+            'L': self.cmd_load,
+            'LOADPAUSED': self.cmd_load_paused,
+            'LP': self.cmd_load_paused,
+            'STOP': self.cmd_stop,
+            'S': self.cmd_stop,
+            'PAUSE': self.cmd_pause,
+            'P': self.cmd_pause,
+            'HELP': self.cmd_help,
+            'H': self.cmd_help,
+            'SILENCE': self.cmd_silence,
+            'SAMPLE': self.cmd_sample,
+        }
+
+    def write(self, msg):
+        self.writer.write('{}\n'.format(msg).encode())
+
+    async def run(self):
+        self.write('@R {}'.format(self.VERSION))
+        async for line in self.reader:
+            line = line.decode().strip()
+            if not line:
+                continue
+            cmd, _sep, arg = line.partition(' ')
+            cmd = cmd.upper()
+            if cmd in ['QUIT', 'Q']:
+                break
+            handler = self.cmd_handlers.get(cmd)
+            if handler is None:
+                self.write(
+                        '@E Unknown command or no arguments: {}'.format(cmd))
+            else:
+                handler(arg.strip())
+            await self.writer.drain()
+        task = self.play_task
+        if task is not None:
+            self.stop_track()
+            await asyncio.gather(task, return_exceptions=True)
+        await self.writer.drain()
+
+    def stop_track(self):
+        if self.play_task is not None:
+            self.play_task.cancel()
+            self.play_task = None
+
+    def cmd_load(self, filename, paused=False):
+        if not filename:
+            self.write('@E No stream opened.')
+            return
+        self.stop_track()
+        self.frame = 0
+        self.loaded = True
+        self.write('@I {}'.format(os.path.basename(filename)))
+        self.write('@S {}'.format(self.STREAM_INFO))
+        if paused:
+            self.unpaused.clear()
+            self.write('@P 1')
+        else:
+            self.unpaused.set()
+            self.write('@P 2')
+        self.play_task = asyncio.ensure_future(self.play_track())
+
+    def cmd_load_paused(self, filename):
+        self.cmd_load(filename, paused=True)
+
+    def cmd_stop(self, _arg):
+        if self.play_task is not None:
+            self.stop_track()
+            self.write('@P 0')
+
+    def cmd_pause(self, _arg):
+        if self.play_task is None:
+            return
+        if self.unpaused.is_set():
+            self.unpaused.clear()
+            self.write('@P 1')
+        else:
+            self.unpaused.set()
+            self.write('@P 2')
+
+    def cmd_help(self, _arg):
+        self.write('@H {')
+        for name in sorted(self.cmd_handlers):
+            if len(name) > 2:
+                self.write('@H {}'.format(name))
+        self.write('@H }')
+
+    def cmd_silence(self, _arg):
+        self.silent = True
+
+    def cmd_sample(self, _arg):
+        if not self.loaded:
+            self.write('@E No stream opened.')
+            return
+        self.write('@SAMPLE {} {}'.format(
+            self.frame * SAMPLES_PER_FRAME,
+            self.total_frames * SAMPLES_PER_FRAME))
+
+    async def play_track(self):
+        total = self.total_frames
+        while self.frame < total:
+            if not self.unpaused.is_set():
+                await self.unpaused.wait()
+            self.frame = min(self.frame + self.frame_step, total)
+            if not self.silent:
+                frames_left = total - self.frame
+                self.write('@F {} {} {:.2f} {:.2f}'.format(
+                    self.frame, frames_left,
+                    self.frame * FRAME_SECONDS, frames_left * FRAME_SECONDS))
+            if self.frame_interval > 0:
+                await asyncio.sleep(self.frame_interval)
+            else:
+                # Still give the commands a chance to run
+                await self.writer.drain()
+                await asyncio.sleep(0)
+        self.play_task = None
+        self.write('@P 0')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            prog='music163-fakempg123',
+            description='Pretend to be "mpg123 --remote"')
+    parser.add_argument('-R', '--remote', action='store_true',
+            help='accepted for compatibility, always on')
+    parser.add_argument('--track-length', type=float, default=240,
+            help='length of every track, in seconds')
+    parser.add_argument('--frame-rate', type=float,
+            default=1 / FRAME_SECONDS,
+            help='@F messages per second, 0 for no limit')
+    parser.add_argument('--frame-step', type=int, default=1,
+            help='frames to advance on every @F message')
+    args, _unknown = parser.parse_known_args()
+
+    loop = asyncio.get_event_loop()
+    reader, writer = loop.run_until_complete(async_stdio(loop))
+    player = FakeMpg123(
+            reader, writer,
+            track_length=args.track_length,
+            frame_rate=args.frame_rate,
+            frame_step=args.frame_step,
+            loop=loop)
+    loop.run_until_complete(player.run())
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
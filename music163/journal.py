@@ -0,0 +1,192 @@
+import os
+import json
+import asyncio
+
+
+class RejectedBatchError(Exception):
+    # Raised by a JournalFlusher's send() when the entries are refused
+    # for good, i.e. sending them again won't help
+    pass
+
+
+class Journal:
+    # Pending entries, one JSON object per line. New entries are appended
+    # to the file; it only gets rewritten when some entries are committed.
+
+    def __init__(self):
+        self.filename = None
+        self.entries = []
+        self.out_file = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def set_filename(self, filename):
+        self.filename = filename
+
+    def load(self):
+        entries = []
+        with open(self.filename, 'r') as in_file:
+            for line in in_file:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # Most likely a partial line from an interrupted
+                    # write, skip it
+                    continue
+        self.entries = entries + self.entries
+
+    def append(self, entry):
+        self.entries.append(entry)
+        if self.filename is None:
+            return
+        if self.out_file is None:
+            self.out_file = open(self.filename, 'a')
+        self.out_file.write(json.dumps(entry) + '\n')
+        self.out_file.flush()
+
+    def peek(self, count):
+        return self.entries[:count]
+
+    def commit(self, count):
+        del self.entries[:count]
+        if self.filename is None:
+            return
+        self.close()
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as out_file:
+            for e in self.entries:
+                out_file.write(json.dumps(e) + '\n')
+        os.replace(tmp_filename, self.filename)
+
+    def close(self):
+        if self.out_file is not None:
+            self.out_file.close()
+            self.out_file = None
+
+
+class JournalFlusher:
+    # Sends the entries in a journal in batches. A batch goes out after
+    # FLUSH_DELAY seconds, or right away when FLUSH_THRESHOLD entries are
+    # pending. Failed batches are retried with exponential backoff.
+    FLUSH_DELAY = 30
+    FLUSH_THRESHOLD = 20
+    MAX_BATCH_SIZE = 50
+    MIN_RETRY_DELAY = 5
+    MAX_RETRY_DELAY = 600
+    # How long close() waits for a batch that is being sent
+    CLOSE_TIMEOUT = 5
+
+    def __init__(self, journal, send, on_error=None, loop=None,
+                 delay=None, threshold=None, max_batch_size=None,
+                 on_reject=None):
+        self.journal = journal
+        # send(entries) is a coroutine function, and should raise an
+        # exception when the entries are not accepted. The batch is
+        # retried later, unless the exception is a RejectedBatchError.
+        self.send = send
+        self.on_error = on_error
+        # on_reject(exc, entries) is called for the entries dropped
+        self.on_reject = on_reject
+        self.loop = loop or asyncio.get_event_loop()
+        self.delay = delay if delay is not None else self.FLUSH_DELAY
+        self.threshold = \
+                threshold if threshold is not None else self.FLUSH_THRESHOLD
+        self.max_batch_size = max_batch_size or self.MAX_BATCH_SIZE
+        self.timer = None
+        self.timer_deadline = None
+        self.flush_task = None
+        self.retry_delay = 0
+
+    def start(self):
+        # Entries left over from the last session
+        if len(self.journal) > 0:
+            self.schedule(0)
+
+    def add(self, entry):
+        self.journal.append(entry)
+        if self.retry_delay > 0:
+            # The retry timer is already set
+            return
+        if len(self.journal) >= self.threshold:
+            self.schedule(0)
+        else:
+            self.schedule(self.delay)
+
+    def retry_now(self):
+        # For when the server is known to be reachable again
+        if self.retry_delay > 0 and len(self.journal) > 0:
+            self.schedule(0)
+
+    def schedule(self, delay):
+        if self.flush_task is not None:
+            # New entries will be picked up by the running flush
+            return
+        deadline = self.loop.time() + delay
+        if self.timer is not None:
+            if self.timer_deadline <= deadline:
+                return
+            self.timer.cancel()
+        self.timer = self.loop.call_later(delay, self._start_flush)
+        self.timer_deadline = deadline
+
+    def _start_flush(self):
+        self.timer = None
+        self.flush_task = asyncio.ensure_future(self.flush())
+        self.flush_task.add_done_callback(self._check_flush_task)
+
+    async def flush(self):
+        while len(self.journal) > 0:
+            batch = self.journal.peek(self.max_batch_size)
+            try:
+                await self.send(batch)
+            except RejectedBatchError as e:
+                # Don't let it hold up the entries after it
+                self.journal.commit(len(batch))
+                if self.on_reject is not None:
+                    self.on_reject(e, batch)
+                continue
+            self.journal.commit(len(batch))
+
+    def _check_flush_task(self, future):
+        self.flush_task = None
+        if future.cancelled():
+            return
+        exc = future.exception()
+        if exc is None:
+            self.retry_delay = 0
+            # Entries added after flush() was done, but before this
+            # callback ran, were not scheduled
+            if len(self.journal) > 0:
+                self.schedule(self.delay)
+            return
+        self.retry_delay = min(
+                max(self.retry_delay * 2, self.MIN_RETRY_DELAY),
+                self.MAX_RETRY_DELAY)
+        self.schedule(self.retry_delay)
+        if self.on_error is not None:
+            self.on_error(exc, self.retry_delay)
+
+    async def close(self, flush=True):
+        if self.flush_task is not None:
+            # The batch being sent may have reached the server already,
+            # cancelling it and sending it again could duplicate it
+            task = self.flush_task
+            await asyncio.wait([task], timeout=self.CLOSE_TIMEOUT)
+            if not task.done():
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                # Whatever is left gets sent next time
+                flush = False
+            self.flush_task = None
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        # Don't hold up the exit when the server is known to be
+        # unreachable, the entries will be sent next time
+        if flush and self.retry_delay == 0:
+            try:
+                await self.flush()
+            except Exception:
+                pass
+        self.journal.close()
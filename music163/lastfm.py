@@ -5,6 +5,7 @@ import os
 import json
 
 from .api import APIError
+from .journal import (JournalFlusher, RejectedBatchError)
 from .version import __version__
 
 
@@ -34,6 +35,11 @@ class LastFMAPIFunc:
         else:
             self.params = []
 
+    def __get__(self, api_obj, owner=None):
+        if api_obj is None:
+            return self
+        return types.MethodType(self, api_obj)
+
     def __call__(self, api_obj, *args):
         args_num = len(self.params)
         if len(args) != args_num:
@@ -46,23 +52,8 @@ class LastFMAPIFunc:
         }
         for p in self.params:
             r_params[p] = args.pop(0)
-        if self.require_auth:
-            r_params.update(api_obj.credentials)
-            m = hashlib.md5()
-            sig_str = bytearray()
-            for k in sorted(r_params.keys()):
-                m.update(k.encode())
-                m.update(r_params[k].encode())
-            m.update(api_obj.shared_secret.encode())
-            r_params['api_sig'] = m.hexdigest()
-        r_params['format'] = 'json'
-        if self.request_method == 'get':
-            r = api_obj.session.get(LAST_FM_API_ROOT,
-                    params=r_params, timeout=api_obj.request_timeout)
-        elif self.request_method == 'post':
-            r = api_obj.session.post(LAST_FM_API_ROOT,
-                    data=r_params, timeout=api_obj.request_timeout)
-        return ((r.status_code, r.reason), r.json())
+        return api_obj.call_method(
+                r_params, self.request_method, self.require_auth)
 
 
 class LastFMAPI:
@@ -94,13 +85,8 @@ class LastFMAPI:
         params=['track', 'artist', 'album', 'timestamp']
     )
 
-    def __new__(cls, *args, **kwargs):
-        obj = super().__new__(cls)
-        for a in dir(obj):
-            attr = getattr(obj, a)
-            if isinstance(attr, LastFMAPIFunc):
-                setattr(obj, a, types.MethodType(attr, obj))
-        return obj
+    # LastFM accepts at most this many scrobbles in one request
+    MAX_SCROBBLES = 50
 
     def __init__(self, api_key, shared_secret, session=None):
         self.shared_secret = shared_secret
@@ -110,11 +96,78 @@ class LastFMAPI:
         self.credentials = {'api_key': api_key}
         self.request_timeout = None
 
+    def sign_params(self, params):
+        # Works for array-indexed params (e.g. 'track[0]') too, they are
+        # sorted by name as plain strings
+        m = hashlib.md5()
+        for k in sorted(params.keys()):
+            m.update(k.encode())
+            m.update(params[k].encode())
+        m.update(self.shared_secret.encode())
+        return m.hexdigest()
+
+    def call_method(self, params, request_method='get', require_auth=False):
+        r_params = dict(params)
+        if require_auth:
+            r_params.update(self.credentials)
+            r_params['api_sig'] = self.sign_params(r_params)
+        r_params['format'] = 'json'
+        if request_method == 'get':
+            r = self.session.get(LAST_FM_API_ROOT,
+                    params=r_params, timeout=self.request_timeout)
+        elif request_method == 'post':
+            r = self.session.post(LAST_FM_API_ROOT,
+                    data=r_params, timeout=self.request_timeout)
+        return ((r.status_code, r.reason), r.json())
+
+    def track_scrobble_batch(self, scrobbles):
+        if len(scrobbles) > self.MAX_SCROBBLES:
+            raise APIError(
+                'too many scrobbles for track.scrobble: {} > {}'.format(
+                    len(scrobbles), self.MAX_SCROBBLES))
+        r_params = {
+            'method': 'track.scrobble',
+        }
+        for i, s in enumerate(scrobbles):
+            for k in ['track', 'artist', 'album', 'timestamp']:
+                r_params['{}[{}]'.format(k, i)] = s[k]
+        return self.call_method(r_params, 'post', True)
+
     def build_authorization_url(self):
         return 'http://www.last.fm/api/auth/?api_key={}&token={}'.format(
                 self.credentials['api_key'], self.credentials['token'])
 
 
+class LastFMScrobbler(JournalFlusher):
+    # Scrobbles are kept in a journal until LastFM accepts them. They
+    # can wait for a while, LastFM takes timestamps from up to two weeks
+    # ago.
+    FLUSH_DELAY = 30 * 60
+    FLUSH_THRESHOLD = LastFMAPI.MAX_SCROBBLES
+    MAX_BATCH_SIZE = LastFMAPI.MAX_SCROBBLES
+    # LastFM errors worth retrying: 11 (service offline), 16 (temporarily
+    # unavailable) and 29 (rate limit exceeded). Scrobbles refused with
+    # other errors are dropped.
+    RETRY_ERRORS = [11, 16, 29]
+
+    def __init__(self, lastfm_api, journal, on_error=None, loop=None,
+                 on_reject=None):
+        super().__init__(
+                journal, self.send_scrobbles, on_error=on_error, loop=loop,
+                on_reject=on_reject)
+        self.lastfm_api = lastfm_api
+
+    async def send_scrobbles(self, scrobbles):
+        r = await self.loop.run_in_executor(
+                None, self.lastfm_api.track_scrobble_batch, scrobbles)
+        if 'error' in r[1]:
+            if r[1]['error'] in self.RETRY_ERRORS:
+                raise APIError(r)
+            raise RejectedBatchError(r)
+        if r[0][0] != 200:
+            raise APIError(r)
+
+
 def lastfm_login(api_key, shared_secret, info_file):
     lfm_api = LastFMAPI(api_key, shared_secret)
     r = lfm_api.auth_get_token()
@@ -0,0 +1,228 @@
+import re
+import asyncio
+import multiprocessing
+import urllib.parse as urlparse
+from concurrent.futures import ProcessPoolExecutor
+from lxml import etree
+from .api import (MUSIC_163_SCHEME, MUSIC_163_DOMAIN)
+
+
+# e.g. /song?id=123, or http://music.163.com/#/album?id=456
+LINK_RE = re.compile(r'^.*/(song|album|playlist|artist)/?\?id=([0-9]+)$')
+LINK_KINDS = ['song', 'album', 'playlist', 'artist']
+CHUNK_SIZE = 64 * 1024
+
+
+class PageError(Exception):
+    pass
+
+
+def normalize_page_url(page_url):
+    # The scheme and domain of music.163.com can be omitted
+    u = urlparse.urlparse(page_url)
+    if not u.scheme:
+        scheme = MUSIC_163_SCHEME
+    else:
+        scheme = u.scheme
+    if not u.netloc:
+        netloc = MUSIC_163_DOMAIN
+    else:
+        netloc = u.netloc
+    return urlparse.urlunparse(
+            (scheme, netloc, u.path, u.params, u.query, u.fragment))
+
+
+class PageLinks:
+    # IDs of the objects linked from a page, by kind, in the order they
+    # first show up
+
+    def __init__(self, ids=None):
+        self.ids = {kind: [] for kind in LINK_KINDS}
+        self.seen = {kind: set() for kind in LINK_KINDS}
+        if ids is not None:
+            for kind, obj_ids in ids.items():
+                for obj_id in obj_ids:
+                    self.add(kind, obj_id)
+
+    def add(self, kind, obj_id):
+        seen = self.seen[kind]
+        if obj_id not in seen:
+            seen.add(obj_id)
+            self.ids[kind].append(obj_id)
+
+    def merge(self, other):
+        for kind, obj_ids in other.ids.items():
+            for obj_id in obj_ids:
+                self.add(kind, obj_id)
+
+    @property
+    def song_ids(self):
+        return self.ids['song']
+
+    def to_json(self):
+        return self.ids
+
+
+class _LinkTarget:
+    # Parser target that only looks at <a> tags. No tree gets built, so
+    # memory use doesn't grow with the size of the page.
+
+    def __init__(self, links):
+        self.links = links
+
+    def start(self, tag, attrib):
+        if tag != 'a':
+            return
+        href = attrib.get('href')
+        if not href:
+            return
+        m = LINK_RE.match(href)
+        if m is not None:
+            self.links.add(m.group(1), int(m.group(2)))
+
+    def close(self):
+        return self.links
+
+
+class LinkExtractor:
+    # Feed the page as it arrives, then close() to get the links
+
+    def __init__(self, encoding=None):
+        self.links = PageLinks()
+        self.parser = etree.HTMLParser(
+                target=_LinkTarget(self.links), encoding=encoding)
+        self.fed = False
+
+    def feed(self, data):
+        if data:
+            self.parser.feed(data)
+            self.fed = True
+
+    def close(self):
+        if not self.fed:
+            # lxml refuses to close a parser that got no data
+            return self.links
+        return self.parser.close()
+
+
+def extract_links(page_text):
+    extractor = LinkExtractor()
+    extractor.feed(page_text)
+    return extractor.close()
+
+
+def extract_song_ids(page_text):
+    return extract_links(page_text).song_ids
+
+
+def extract_link_ids(page_data):
+    # For running in worker processes, plain dicts are cheaper to send
+    # back than PageLinks
+    return extract_links(page_data).to_json()
+
+
+def _conditional_headers(page_cache, page_url):
+    headers = {}
+    if page_cache is None:
+        return headers
+    entry = page_cache.get(page_url)
+    if entry is not None:
+        if entry['etag'] is not None:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified'] is not None:
+            headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+def _check_status(page_cache, page_url, status, reason):
+    # Returns the cached links when the page is not modified
+    if status == 304 and page_cache is not None:
+        entry = page_cache.get(page_url)
+        if entry is not None:
+            return PageLinks(entry['links'])
+    if status != 200:
+        raise PageError('{} {}'.format(status, reason))
+    return None
+
+
+def _cache_links(page_cache, page_url, resp_headers, links):
+    if page_cache is not None:
+        page_cache.put(
+                page_url, links.to_json(),
+                resp_headers.get('ETag'), resp_headers.get('Last-Modified'))
+
+
+def fetch_page_links(session, page_url, page_cache=None):
+    # Blocking version, with a requests session
+    headers = _conditional_headers(page_cache, page_url)
+    with session.get(page_url, headers=headers, stream=True) as r:
+        links = _check_status(page_cache, page_url, r.status_code, r.reason)
+        if links is not None:
+            return links
+        extractor = LinkExtractor()
+        for chunk in r.iter_content(CHUNK_SIZE):
+            extractor.feed(chunk)
+        links = extractor.close()
+        _cache_links(page_cache, page_url, r.headers, links)
+        return links
+
+
+async def async_fetch_page_links(api, page_url, page_cache=None):
+    # With an AsyncMusic163API
+    headers = _conditional_headers(page_cache, page_url)
+    extractor = LinkExtractor()
+    status, reason, resp_headers = await api.stream(
+            page_url, extractor.feed, headers=headers, chunk_size=CHUNK_SIZE)
+    links = _check_status(page_cache, page_url, status, reason)
+    if links is not None:
+        return links
+    links = extractor.close()
+    _cache_links(page_cache, page_url, resp_headers, links)
+    return links
+
+
+async def _fetch_page_links_in(api, page_url, page_cache, executor):
+    headers = _conditional_headers(page_cache, page_url)
+    chunks = []
+    status, reason, resp_headers = await api.stream(
+            page_url, chunks.append, headers=headers, chunk_size=CHUNK_SIZE)
+    links = _check_status(page_cache, page_url, status, reason)
+    if links is not None:
+        return links
+    loop = asyncio.get_event_loop()
+    link_ids = await loop.run_in_executor(
+            executor, extract_link_ids, b''.join(chunks))
+    links = PageLinks(link_ids)
+    _cache_links(page_cache, page_url, resp_headers, links)
+    return links
+
+
+def make_parse_executor(max_workers=None):
+    # Forking a process that already has threads (e.g. the event loop's
+    # default executor) may deadlock in the child, so the workers are
+    # started from a fresh server process instead, where available
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        mp_context = multiprocessing.get_context('forkserver')
+    else:
+        mp_context = multiprocessing.get_context('spawn')
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context)
+
+
+async def async_fetch_pages_links(api, page_urls, page_cache=None,
+                                  executor=None):
+    # All pages are fetched at once, and parsed in the executor (e.g. a
+    # ProcessPoolExecutor). Returns the links of all pages merged in the
+    # order of page_urls, and a list of (page_url, exception) for the
+    # pages that failed.
+    results = await asyncio.gather(
+            *[_fetch_page_links_in(api, u, page_cache, executor)
+              for u in page_urls],
+            return_exceptions=True)
+    merged = PageLinks()
+    errors = []
+    for page_url, r in zip(page_urls, results):
+        if isinstance(r, BaseException):
+            errors.append((page_url, r))
+        else:
+            merged.merge(r)
+    return (merged, errors)
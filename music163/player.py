@@ -1,17 +1,25 @@
 import sys
 import os
 import re
-import io
 import random
+import array
+import json
 import requests
+import aiohttp
 import asyncio
 import math
+import functools
+import collections
 from datetime import datetime
 from asyncio import (subprocess, streams)
 from concurrent.futures import FIRST_COMPLETED
-import urllib.parse as urlparse
-from lxml import etree
-from .api import (MUSIC_163_SCHEME, MUSIC_163_DOMAIN)
+from .api import (APIError, AsyncMusic163API)
+from .cache import (UrlCache, PageCache, ResultCache)
+from .page import (PageError, normalize_page_url, async_fetch_page_links,
+        async_fetch_pages_links, make_parse_executor)
+from .store import MetadataStore
+from .journal import (Journal, JournalFlusher, RejectedBatchError)
+from .lastfm import LastFMScrobbler
 
 
 async def async_stdio(loop=None):
@@ -32,9 +40,50 @@ async def async_stdio(loop=None):
     return reader, writer
 
 
-def get_song_display_name(song):
-    artist_names = [a['name'] for a in song['artists']]
-    return '{} - {}'.format(song['name'], ', '.join(artist_names))
+class Track:
+    # What the player keeps for every song in the playlist, instead of the
+    # whole JSON object from the server
+    __slots__ = ('id', 'name', 'artist_names', 'album_name', 'duration',
+                 'display_name')
+
+    def __init__(self, id, name, artist_names, album_name, duration=None):
+        self.id = id
+        self.name = name
+        self.artist_names = artist_names
+        self.album_name = album_name
+        self.duration = duration
+        if name is None:
+            # Only the ID is known for now, see Mpg123.hydrate_tracks()
+            self.display_name = 'Song {}'.format(id)
+        else:
+            self.display_name = \
+                    '{} - {}'.format(name, ', '.join(artist_names))
+
+    @classmethod
+    def placeholder(cls, song_id):
+        return cls(song_id, None, (), None)
+
+    def is_placeholder(self):
+        return self.name is None
+
+    @classmethod
+    def from_song(cls, song):
+        if song is None or isinstance(song, cls):
+            return song
+        # Newer APIs use 'ar', 'al' and 'dt' instead
+        artists = song.get('artists', song.get('ar')) or []
+        album = song.get('album', song.get('al'))
+        if album and album.get('name'):
+            # The same artist and album names show up over and over in
+            # large playlists, only keep one copy of each
+            album_name = sys.intern(album['name'])
+        else:
+            album_name = None
+        return cls(
+                song['id'], song['name'],
+                tuple([sys.intern(a['name'] or '') for a in artists]),
+                album_name,
+                song.get('duration', song.get('dt')))
 
 
 class PlayerAPIError(Exception):
@@ -50,41 +99,72 @@ class PlayerError(Exception):
 
 
 class AsyncLogger:
-    def __init__(self, writer):
+    # Lines are collected and written out together once per event loop
+    # iteration. Callers printing lots of lines should await flush() now
+    # and then, so that the output can't pile up faster than it's read.
+    OUTPUT_FORMATS = ['text', 'json']
+    TEXT_PREFIX = '--  '
+    LEVEL_PREFIXES = {
+        'debug': 'Debug: ',
+        'info': '',
+        'warning': 'Warning: ',
+        'error': 'Error: ',
+    }
+
+    def __init__(self, writer, output_format='text'):
         self.writer = writer
-
-    def print_to_str(self, *args, **kwargs):
-        out = io.StringIO()
-        print(*args, **kwargs, end='', file=out)
-        return out.getvalue()
-
-    def aprint(self, *args, **kwargs):
-        out = io.StringIO()
-        print('--  ', end='', file=out)
-        print(*args, **kwargs, file=out)
-        self.writer.write(out.getvalue().encode())
+        self.output_format = output_format
+        self.pending = []
+        self.write_handle = None
+        self.loop = asyncio.get_event_loop()
+
+    def set_output_format(self, output_format):
+        self.output_format = output_format
+
+    def print_to_str(self, *args, sep=' ', **_kwargs):
+        if len(args) == 1:
+            return str(args[0])
+        return sep.join([str(a) for a in args])
+
+    def format_line(self, level, msg):
+        if self.output_format == 'json':
+            return json.dumps({'level': level, 'message': msg}) + '\n'
+        return self.TEXT_PREFIX + self.LEVEL_PREFIXES[level] + msg + '\n'
+
+    def emit(self, level, msg):
+        self.pending.append(self.format_line(level, msg))
+        if self.write_handle is None:
+            self.write_handle = self.loop.call_soon(self.write_pending)
+
+    def write_pending(self):
+        if self.write_handle is not None:
+            self.write_handle.cancel()
+            self.write_handle = None
+        if self.pending:
+            data = ''.join(self.pending).encode()
+            self.pending = []
+            self.writer.write(data)
 
     async def flush(self):
+        self.write_pending()
+        # Only blocks when the transport buffer is over its high-water mark
         await self.writer.drain()
 
     def debug(self, *args, **kwargs):
-        msg = self.print_to_str(*args, **kwargs)
-        self.aprint('Debug:', msg)
+        self.emit('debug', self.print_to_str(*args, **kwargs))
 
     def info(self, *args, **kwargs):
-        self.aprint(*args, **kwargs)
+        self.emit('info', self.print_to_str(*args, **kwargs))
 
     def warning(self, *args, **kwargs):
-        msg = self.print_to_str(*args, **kwargs)
-        self.aprint('Warning:', msg)
+        self.emit('warning', self.print_to_str(*args, **kwargs))
 
     def error(self, *args, **kwargs):
-        msg = self.print_to_str(*args, **kwargs)
-        self.aprint('Error:', msg)
+        self.emit('error', self.print_to_str(*args, **kwargs))
 
 
 class PlayerCommand:
-    CMD_RE = re.compile('^([A-Za-z0-9_]+)\s*')
+    CMD_RE = re.compile(r'^([A-Za-z0-9_]+)\s*')
     PLAYLIST_FETCH_LIMIT = 1001
 
     def __init__(self, player, api, logger):
@@ -109,7 +189,18 @@ class PlayerCommand:
                 api_func, *api_args, notice=notice, err_msg=err_msg)
         return r
 
-    async def fetch_playlists(self, user_id):
+    async def fetch_song_details(self, song_ids, notice=None, err_msg=None):
+        found = await self.player.fetch_song_details(
+                song_ids, notice=notice, err_msg=err_msg)
+        return [found[sid] for sid in song_ids if sid in found]
+
+    async def fetch_playlists(self, user_id, refresh=False):
+        store = self.player.metadata_store
+        if not refresh:
+            pl_list = store.get('user_playlists', user_id)
+            if pl_list is not None:
+                return pl_list
+
         self.logger.info('Fetching playlist(s)...')
         offset = 0
         more = True
@@ -119,22 +210,63 @@ class PlayerCommand:
                     self.api.user_playlist,
                     offset, self.PLAYLIST_FETCH_LIMIT, user_id,
                     err_msg='Failed to fetch playlist(s)')
-            pl_list.extend(r['playlist'])
+            pl_list.extend([self._summarize_playlist(p) for p in r['playlist']])
             # The API doesn't seem to count the special playlist in 'offset',
             # so exclude it. I don't know whether this is a bug on the server
             # side...
-            new_offset = offset + len([pl for pl in pl_list if pl['specialType'] != 5])
+            new_offset = offset + \
+                    len([pl for pl in r['playlist'] if pl['specialType'] != 5])
             if offset == new_offset:
                 offset += 1
             else:
                 offset = new_offset
             more = r['more']
 
-        if len(pl_list) == 0:
-            self.logger.info('No playlist found')
-
+        # Cached tracks of the playlists that changed since they were
+        # fetched are out of date
+        for kind in ['playlist', 'playlist_ids']:
+            changed = []
+            for p in pl_list:
+                cached_time = store.get_update_time(kind, p['id'])
+                if cached_time is not None and \
+                        cached_time != p['updateTime']:
+                    changed.append(p['id'])
+            if changed:
+                store.delete_many(kind, changed)
+        store.put('user_playlists', user_id, pl_list)
         return pl_list
 
+    def _summarize_playlist(self, pl):
+        return {
+            'id': pl['id'],
+            'name': pl['name'],
+            'trackCount': pl['trackCount'],
+            'specialType': pl['specialType'],
+            'updateTime': pl.get('updateTime'),
+        }
+
+    def forget_playlists(self, user_id=None):
+        if user_id is None:
+            user_id = self.api.profile['userId']
+        self.player.metadata_store.delete_many('user_playlists', [user_id])
+
+    async def get_liked_playlist_id(self):
+        # The "liked songs" playlist never changes for an account, so
+        # it's looked up only once and kept in the profile
+        profile = self.api.profile
+        pl_id = profile.get('likedPlaylistId')
+        if pl_id is not None:
+            return pl_id
+        pl_list = await self.fetch_playlists(profile['userId'])
+        liked = [p['id'] for p in pl_list if p['specialType'] == 5]
+        if not liked:
+            raise PlayerError('Default playlist not found')
+        pl_id = liked[0]
+        profile['likedPlaylistId'] = pl_id
+        if profile.filename is not None:
+            profile.save()
+        return pl_id
+
     async def call_sub_command(self, sub_name, sub_cmd, *args):
         try:
             cr = sub_cmd(*args)
@@ -176,10 +308,13 @@ class CmdPlay(PlayerCommand):
             'pl': self._play_playlist,
             'song': self._play_song,
             'page': self._play_page,
+            'pages': self._play_pages,
             'radio': self._play_radio,
             'program': self._play_program,
             'prog': self._play_program,
             'none': self._play_none,
+            'next': self._play_next,
+            'prev': self._play_prev,
         }
 
     async def _play_recommended(self):
@@ -199,14 +334,46 @@ class CmdPlay(PlayerCommand):
         except ValueError:
             raise PlayerCmdError('Invalid playlist: {}'.format(pl_id))
 
-        r = await self.call_api(
-                self.api.playlist_detail, pl_id,
-                notice='Fetching playlist {}...'.format(pl_id),
-                err_msg='Failed to fetch playlist {}'.format(pl_id))
-        self.player.set_playlist(r['result']['tracks'])
+        # Only the track IDs are needed to start playing, the details
+        # are filled in by the player as needed
+        playlist = self.player.metadata_store.get('playlist_ids', pl_id)
+        if playlist is None:
+            playlist = await self._fetch_playlist(
+                    pl_id, notice='Fetching playlist {}...'.format(pl_id))
+        else:
+            # Start playing right away, and check for updates in the
+            # background
+            task = asyncio.ensure_future(
+                    self._revalidate_playlist(pl_id, playlist.get('updateTime')))
+            task.add_done_callback(self.player.check_cmd_task)
+        self.player.set_lazy_playlist(playlist['trackIds'])
         self.player.reset_current_song()
         await self.player.play_next_song()
 
+    async def _fetch_playlist(self, pl_id, notice=None):
+        r = await self.call_api(
+                self.api.playlist_detail_v3, pl_id, self.player.HYDRATE_WINDOW,
+                notice=notice,
+                err_msg='Failed to fetch playlist {}'.format(pl_id))
+        store = self.player.metadata_store
+        # Details for the first few tracks come with the playlist
+        store.put_songs(r['playlist']['tracks'])
+        playlist = {
+            'id': pl_id,
+            'name': r['playlist']['name'],
+            'updateTime': r['playlist'].get('updateTime'),
+            'trackIds': [t['id'] for t in r['playlist']['trackIds']],
+        }
+        store.put('playlist_ids', pl_id, playlist, playlist['updateTime'])
+        return playlist
+
+    async def _revalidate_playlist(self, pl_id, update_time):
+        playlist = await self._fetch_playlist(pl_id)
+        if playlist.get('updateTime') != update_time:
+            self.logger.info(
+                    'Playlist {} has been updated, play it again to get the new tracks'
+                    .format(pl_id))
+
     async def _play_song(self, *song_ids):
         if len(song_ids) == 0:
             raise PlayerCmdError('Which song(s) to play?')
@@ -215,55 +382,56 @@ class CmdPlay(PlayerCommand):
         except ValueError:
             raise PlayerCmdError('Invalid song(s): {}'.format(song_ids))
 
-        r = await self.call_api(
-                self.api.song_detail, song_ids,
+        song_list = await self.fetch_song_details(
+                song_ids,
                 notice='Fetching song info...',
                 err_msg='Failed to fetch song(s)')
-        self.player.set_playlist(r['songs'])
+        self.player.set_playlist(song_list)
         self.player.reset_current_song()
         await self.player.play_next_song()
 
     async def _play_page(self, page_url=None):
         if page_url is None:
             raise PlayerCmdError('What page?')
-        u = urlparse.urlparse(page_url)
-        if not u.scheme:
-            scheme = MUSIC_163_SCHEME
-        else:
-            scheme = u.scheme
-        if not u.netloc:
-            netloc = MUSIC_163_DOMAIN
-        else:
-            netloc = u.netloc
-
-        page_url = urlparse.urlunparse(
-                (scheme, netloc, u.path, u.params, u.query, u.fragment))
+        page_url = normalize_page_url(page_url)
 
         self.logger.info('Fetching page...')
-        r = await self.player.loop.run_in_executor(
-                None, self.api.session.get, page_url)
-        if r.status_code != 200:
-            raise PlayerAPIError(
-                    '{} {}'.format(r.status_code, r.reason),
-                    'Failed to fetch page')
-        doc = etree.parse(io.StringIO(r.text), etree.HTMLParser())
-
-        song_ids = []
-        song_pattern = re.compile('^.*/song/?\?id\=([0-9]+)$')
-        for a in doc.iter('a'):
-            href = a.attrib.get('href')
-            if not href:
-                continue
-            m = song_pattern.match(href)
-            if m is None:
-                continue
-            song_ids.append(int(m.group(1)))
+        try:
+            links = await async_fetch_page_links(
+                    self.api, page_url, self.player.page_cache)
+        except PageError as e:
+            raise PlayerAPIError(str(e), 'Failed to fetch page')
 
-        r = await self.call_api(
-                self.api.song_detail, song_ids,
+        song_list = await self.fetch_song_details(
+                links.song_ids,
                 notice='Fetching song info...',
                 err_msg='Failed to fetch song(s)')
-        self.player.set_playlist(r['songs'])
+        self.player.set_playlist(song_list)
+        self.player.reset_current_song()
+        await self.player.play_next_song()
+
+    async def _play_pages(self, *page_urls):
+        if len(page_urls) == 0:
+            raise PlayerCmdError('What pages?')
+        urls = []
+        for u in page_urls:
+            u = normalize_page_url(u)
+            if u not in urls:
+                urls.append(u)
+
+        self.logger.info('Fetching {} page(s)...'.format(len(urls)))
+        links, errors = await async_fetch_pages_links(
+                self.api, urls, self.player.page_cache,
+                self.player.get_page_executor())
+        for page_url, e in errors:
+            self.logger.warning(
+                    'Failed to fetch page {}: {}'.format(page_url, e))
+        if len(errors) == len(urls):
+            raise PlayerError('Failed to fetch page(s)')
+
+        # There may be lots of songs, fetch their details as they're
+        # needed
+        self.player.set_lazy_playlist(links.song_ids)
         self.player.reset_current_song()
         await self.player.play_next_song()
 
@@ -281,9 +449,12 @@ class CmdPlay(PlayerCommand):
                     self.api.personal_fm,
                     notice='Fetching song(s)...',
                     err_msg='Failed to fetch song(s)')
-            song_list = r['data'][:]
-            song_list.append(None)
-            self.player.set_playlist(song_list)
+            # More songs are fetched in the background as the playlist
+            # runs low, see Mpg123.check_radio_queue()
+            self.player.start_radio(r['data'])
+            if not self.player.playlist:
+                # All of them were played recently
+                await self.player.refill_radio()
             await self.player.invoke_player_command(
                     CmdShuffle, 'shuffle', 'false')
         else:
@@ -307,14 +478,27 @@ class CmdPlay(PlayerCommand):
         except ValueError:
             raise PlayerCmdError('Invalid program: {}'.format(prog_id))
 
-        r = await self.call_api(
-                self.api.dj_program_detail, prog_id,
-                notice='Fetching program {}...'.format(prog_id),
-                err_msg='Failed to fetch program: {}'.format(prog_id))
-        self.player.set_playlist([r['program']['mainSong']])
+        store = self.player.metadata_store
+        program = store.get('program', prog_id)
+        if program is None:
+            r = await self.call_api(
+                    self.api.dj_program_detail, prog_id,
+                    notice='Fetching program {}...'.format(prog_id),
+                    err_msg='Failed to fetch program: {}'.format(prog_id))
+            program = r['program']
+            store.put('program', prog_id, program)
+        self.player.set_playlist([program['mainSong']])
         self.player.reset_current_song()
         await self.player.play_next_song()
 
+    async def _play_next(self):
+        self.player.scrobble(end_method='ui')
+        await self.player.play_next_song()
+
+    async def _play_prev(self):
+        self.player.scrobble(end_method='ui')
+        await self.player.play_prev_song()
+
     async def _play_none(self):
         self.player.set_playlist([])
         self.player.reset_current_song()
@@ -337,17 +521,20 @@ class CmdPlay(PlayerCommand):
 
 class CmdList(PlayerCommand):
     NAMES = ['list', 'ls']
+    FLUSH_LINES = 500
 
-    def run(self, _name):
+    async def run(self, _name):
         if not self.player.playlist:
             self.logger.info('Playlist is empty')
         else:
             digits = len(str(len(self.player.playlist)))
             for idx, s in enumerate(self.player.playlist):
                 if s is not None:
-                    display_name = get_song_display_name(s)
+                    display_name = s.display_name
                     self.logger.info(
                             '{:0{}}. {}'.format(idx, digits, display_name))
+                    if idx % self.FLUSH_LINES == self.FLUSH_LINES - 1:
+                        await self.logger.flush()
 
 
 class CmdShuffle(PlayerCommand):
@@ -355,14 +542,7 @@ class CmdShuffle(PlayerCommand):
 
     def run(self, _name, state=None):
         state = self.parse_bool_state(state, self.player.shuffle)
-        if state:
-            if self.player.playlist:
-                self.player.shuffle_playlist()
-            else:
-                self.player.shuffle = True
-        else:
-            self.player.shuffle = False
-
+        self.player.set_shuffle(state)
         self.logger.info('Shuffle: {}'.format(bool(self.player.shuffle)))
 
 
@@ -387,15 +567,27 @@ class CmdBitrate(PlayerCommand):
 class CmdProgress(PlayerCommand):
     NAMES = ['progress', 'pr']
 
-    def run(self, _name):
-        if self.player.is_playing():
-            display_name = get_song_display_name(
-                    self.player.playlist[self.player.current_song])
-            total_frames = self.player.frame_info[0] + self.player.frame_info[1]
-            total_seconds = self.player.frame_info[2] + self.player.frame_info[3]
-            percent = int(self.player.frame_info[0] / total_frames * 100)
+    async def run(self, _name):
+        await self.player.update_progress()
+        if self.player.is_playing() and self.player.frame_info is not None:
+            display_name = \
+                    self.player.playlist[self.player.current_song].display_name
             minutes_played = int(self.player.frame_info[2] // 60)
             seconds_played = int(self.player.frame_info[2] % 60)
+            if self.player.frame_info[1] is None:
+                # The length of the song is not known
+                self.logger.info(
+                        '{}. {}  {}:{:02}'
+                        .format(
+                            self.player.current_song, display_name,
+                            minutes_played, seconds_played))
+                return
+            total_frames = self.player.frame_info[0] + self.player.frame_info[1]
+            total_seconds = self.player.frame_info[2] + self.player.frame_info[3]
+            if total_frames > 0:
+                percent = int(self.player.frame_info[0] / total_frames * 100)
+            else:
+                percent = 0
             minutes_total = int(total_seconds // 60)
             seconds_total = int(total_seconds % 60)
             self.logger.info(
@@ -421,7 +613,11 @@ class CmdUserPlaylists(PlayerCommand):
             except ValueError:
                 raise PlayerCmdError('Invalid user: {}'.format(user_id))
 
-        pl_list = await self.fetch_playlists(user_id)
+        # Always up to date here. The cached index is for commands that
+        # only need to look up a playlist, e.g. fav.
+        pl_list = await self.fetch_playlists(user_id, refresh=True)
+        if len(pl_list) == 0:
+            self.logger.info('No playlist found')
 
         for p in pl_list:
             self.logger.info(
@@ -445,7 +641,7 @@ class CmdFav(PlayerCommand):
             if m is not None:
                 song_pl_idx = int(m.group(1))
                 try:
-                    song_id = self.player.playlist[song_pl_idx]['id']
+                    song_id = self.player.playlist[song_pl_idx].id
                 except (IndexError, TypeError):
                     if not self.player.playlist:
                         msg = 'Playlist is empty'
@@ -456,7 +652,7 @@ class CmdFav(PlayerCommand):
                 if song_spec == '.':
                     if self.player.is_playing():
                         cur_song = self.player.current_song
-                        song_id = self.player.playlist[cur_song]['id']
+                        song_id = self.player.playlist[cur_song].id
                     else:
                         raise PlayerError('Not playing')
                 else:
@@ -468,7 +664,7 @@ class CmdFav(PlayerCommand):
         else:
             if self.player.is_playing():
                 cur_song = self.player.current_song
-                song_id = self.player.playlist[cur_song]['id']
+                song_id = self.player.playlist[cur_song].id
             else:
                 raise PlayerError('Not playing')
 
@@ -480,38 +676,30 @@ class CmdFav(PlayerCommand):
                 pl_id = int(pl_id)
             except ValueError:
                 raise PlayerCmdError('Invalid playlist: {}'.format(pl_id))
-            dst_pls = [pl_id]
         else:
-            my_id = self.player.api.profile['userId']
-            my_pl_list = await self.fetch_playlists(my_id)
-            if not my_pl_list:
-                raise PlayerError('Default playlist not found')
-            dst_pls = [p['id'] for p in my_pl_list if p['specialType'] == 5]
-            if not dst_pls:
-                raise PlayerError('Default playlist not found')
-        return dst_pls
+            pl_id = await self.get_liked_playlist_id()
+        return pl_id
 
-    async def _fav_song(self, song_spec=None, pl_id=None):
+    async def _update_playlist(self, op, song_spec, pl_id):
         song_id = self._get_song_id(song_spec)
-        dst_pls = await self._get_playlist_id(pl_id)
-        for p in dst_pls:
-            r = await self.call_api(
-                    self.api.playlist_manipulate_tracks,
-                    'add', p, [song_id],
-                    notice='Updating playlist {}...'.format(p),
-                    err_msg='Failed to update playlist {}'.format(p))
-            self.logger.info('Done updating playlist {}'.format(p))
+        p = await self._get_playlist_id(pl_id)
+        r = await self.call_api(
+                self.api.playlist_manipulate_tracks,
+                op, p, [song_id],
+                notice='Updating playlist {}...'.format(p),
+                err_msg='Failed to update playlist {}'.format(p))
+        store = self.player.metadata_store
+        store.delete_many('playlist', [p])
+        store.delete_many('playlist_ids', [p])
+        # Track counts in the playlist index are changed too
+        self.forget_playlists()
+        self.logger.info('Done updating playlist {}'.format(p))
+
+    async def _fav_song(self, song_spec=None, pl_id=None):
+        await self._update_playlist('add', song_spec, pl_id)
 
     async def _unfav_song(self, song_spec=None, pl_id=None):
-        song_id = self._get_song_id(song_spec)
-        dst_pls = await self._get_playlist_id(pl_id)
-        for p in dst_pls:
-            r = await self.call_api(
-                    self.api.playlist_manipulate_tracks,
-                    'del', p, [song_id],
-                    notice='Updating playlist {}...'.format(p),
-                    err_msg='Failed to update playlist {}'.format(p))
-            self.logger.info('Done updating playlist {}'.format(p))
+        await self._update_playlist('del', song_spec, pl_id)
 
     async def run(self, name, fav_type=None, *rest):
         if fav_type is None:
@@ -574,15 +762,24 @@ class CmdSearch(PlayerCommand):
 
         return (page, ' '.join(terms))
 
+    async def _fetch_results(self, query, search_type, limit, page, count_key):
+        offset = (page - 1) * limit
+        r = await self.player.search(
+                query, search_type, limit, offset,
+                notice='Fetching search results...',
+                err_msg='Failed to fetch search results')
+        # Get the next page ready while this one is being read
+        if r['result'].get(count_key, 0) > offset + limit:
+            self.player.prefetch_search(
+                    query, search_type, limit, offset + limit)
+        return r
+
     async def _search_song(self, page=None, *terms):
         page, query = self._parse_search_args(page, terms)
 
-        offset = (page - 1) * self.SEARCH_LIMIT_SONG
-        r = await self.call_api(
-                self.api.cloudsearch_get_web,
-                query, self.SEARCH_TYPE_SONG, self.SEARCH_LIMIT_SONG, offset,
-                notice='Fetching search results...',
-                err_msg='Failed to fetch search results')
+        r = await self._fetch_results(
+                query, self.SEARCH_TYPE_SONG, self.SEARCH_LIMIT_SONG,
+                page, 'songCount')
         if r['result']['songCount'] > 0:
             for s in r['result']['songs']:
                 artist_names = [a['name'] for a in s['ar']]
@@ -601,13 +798,9 @@ class CmdSearch(PlayerCommand):
     async def _search_artist(self, page=None, *terms):
         page, query = self._parse_search_args(page, terms)
 
-        offset = (page - 1) * self.SEARCH_LIMIT_ARTIST
-        r = await self.call_api(
-                self.api.cloudsearch_get_web,
-                query, self.SEARCH_TYPE_ARTIST,
-                self.SEARCH_LIMIT_ARTIST, offset,
-                notice='Fetching search results...',
-                err_msg='Failed to fetch search results')
+        r = await self._fetch_results(
+                query, self.SEARCH_TYPE_ARTIST, self.SEARCH_LIMIT_ARTIST,
+                page, 'artistCount')
         if r['result']['artistCount'] > 0:
             for a in r['result']['artists']:
                 if a['trans']:
@@ -627,13 +820,9 @@ class CmdSearch(PlayerCommand):
     async def _search_album(self, page=None, *terms):
         page, query = self._parse_search_args(page, terms)
 
-        offset = (page - 1) * self.SEARCH_LIMIT_ALBUM
-        r = await self.call_api(
-                self.api.cloudsearch_get_web,
-                query, self.SEARCH_TYPE_ALBUM,
-                self.SEARCH_LIMIT_ALBUM, offset,
-                notice='Fetching search results...',
-                err_msg='Failed to fetch search results')
+        r = await self._fetch_results(
+                query, self.SEARCH_TYPE_ALBUM, self.SEARCH_LIMIT_ALBUM,
+                page, 'albumCount')
         if r['result']['albumCount'] > 0:
             for a in r['result']['albums']:
                 artist_names = [aa['name'] for aa in a['artists']]
@@ -662,13 +851,9 @@ class CmdSearch(PlayerCommand):
     async def _search_playlist(self, page=None, *terms):
         page, query = self._parse_search_args(page, terms)
 
-        offset = (page - 1) * self.SEARCH_LIMIT_PLAYLIST
-        r = await self.call_api(
-                self.api.cloudsearch_get_web,
-                query, self.SEARCH_TYPE_PLAYLIST,
-                self.SEARCH_LIMIT_PLAYLIST, offset,
-                notice='Fetching search results...',
-                err_msg='Failed to fetch search results')
+        r = await self._fetch_results(
+                query, self.SEARCH_TYPE_PLAYLIST, self.SEARCH_LIMIT_PLAYLIST,
+                page, 'playlistCount')
         if r['result']['playlistCount'] > 0:
             for p in r['result']['playlists']:
                 self.logger.info(
@@ -684,13 +869,9 @@ class CmdSearch(PlayerCommand):
     async def _search_program(self, page=None, *terms):
         page, query = self._parse_search_args(page, terms)
 
-        offset = (page - 1) * self.SEARCH_LIMIT_PROGRAM
-        r = await self.call_api(
-                self.api.cloudsearch_get_web,
-                query, self.SEARCH_TYPE_PROGRAM,
-                self.SEARCH_LIMIT_PROGRAM, offset,
-                notice='Fetching search results...',
-                err_msg='Failed to fetch search results')
+        r = await self._fetch_results(
+                query, self.SEARCH_TYPE_PROGRAM, self.SEARCH_LIMIT_PROGRAM,
+                page, 'djprogramCount')
         if r['result']['djprogramCount'] > 0:
             for p in r['result']['djprograms']:
                 self.logger.info(
@@ -707,13 +888,9 @@ class CmdSearch(PlayerCommand):
     async def _search_user(self, page=None, *terms):
         page, query = self._parse_search_args(page, terms)
 
-        offset = (page - 1) * self.SEARCH_LIMIT_USER
-        r = await self.call_api(
-                self.api.cloudsearch_get_web,
-                query, self.SEARCH_TYPE_USER,
-                self.SEARCH_LIMIT_USER, offset,
-                notice='Fetching search results...',
-                err_msg='Failed to fetch search results')
+        r = await self._fetch_results(
+                query, self.SEARCH_TYPE_USER, self.SEARCH_LIMIT_USER,
+                page, 'userprofileCount')
         if r['result']['userprofileCount'] > 0:
             for u in r['result']['userprofiles']:
                 if u['signature']:
@@ -766,8 +943,7 @@ class CmdSearch(PlayerCommand):
             raise PlayerCmdError('No search term(s) specified')
 
         query = ' '.join(terms)
-        r = await self.call_api(
-                self.api.search_suggest_web,
+        r = await self.player.suggest(
                 query, self.SEARCH_LIMIT_PLAYLIST,
                 notice='Fetching search results...',
                 err_msg='Failed to fetch search results')
@@ -835,6 +1011,7 @@ class CmdCreatePlaylist(PlayerCommand):
                 self.api.playlist_create, pl_name,
                 notice='Creating playlist {}...'.format(repr(pl_name)),
                 err_msg='Failed to create playlist')
+        self.forget_playlists()
         self.logger.info('Created new playlist {}'.format(r['id']))
 
 
@@ -853,6 +1030,10 @@ class CmdDeletePlaylist(PlayerCommand):
                 self.api.playlist_delete, pl_id,
                 notice='Deleting playlist {}...'.format(pl_id),
                 err_msg='Failed to delete playlist {}'.format(pl_id))
+        self.forget_playlists()
+        store = self.player.metadata_store
+        store.delete_many('playlist', [pl_id])
+        store.delete_many('playlist_ids', [pl_id])
         self.logger.info('Deleted playlist {}'.format(r['id']))
 
 
@@ -865,30 +1046,199 @@ class CmdScrobble(PlayerCommand):
         self.logger.info('Scrobbling: {}'.format(bool(self.player.scrobbling)))
 
 
+class CmdCache(PlayerCommand):
+    NAMES = ['cache']
+
+    def run(self, _name, state=None):
+        audio_cache = self.player.audio_cache
+        if audio_cache is None:
+            raise PlayerError('Audio cache is not available')
+        state = self.parse_bool_state(state, self.player.audio_caching)
+        self.player.audio_caching = state
+        self.logger.info(
+                'Audio cache: {} ({} MiB / {} MiB)'
+                .format(bool(self.player.audio_caching),
+                    audio_cache.total_bytes // (1024 * 1024),
+                    audio_cache.max_bytes // (1024 * 1024)))
+
+
+class CmdOutput(PlayerCommand):
+    NAMES = ['output']
+
+    def run(self, _name, output_format=None):
+        if output_format is not None:
+            output_format = output_format.lower()
+            if output_format not in self.logger.OUTPUT_FORMATS:
+                raise PlayerCmdError(
+                        'Unknown output format: {}'.format(output_format))
+            self.logger.set_output_format(output_format)
+        self.logger.info(
+                'Output format: {}'.format(self.logger.output_format))
+
+
+class ShuffleOrder:
+    # A random permutation of playlist indices, together with the position
+    # of every index in it, so that the songs before and after any song
+    # can be found without scanning the permutation
+
+    def __init__(self, size=0):
+        self.order = array.array('l', range(size))
+        random.shuffle(self.order)
+        self.positions = array.array('l', bytes(self.order.itemsize * size))
+        for pos, idx in enumerate(self.order):
+            self.positions[idx] = pos
+
+    def __len__(self):
+        return len(self.order)
+
+    def extend(self, count, after=-1):
+        # New indices are shuffled into the part of the order after
+        # position 'after', i.e. the songs not played yet in this round
+        for _ in range(count):
+            new_idx = len(self.order)
+            pos = random.randint(after + 1, new_idx)
+            self.positions.append(pos)
+            if pos == new_idx:
+                self.order.append(new_idx)
+            else:
+                moved_idx = self.order[pos]
+                self.order.append(moved_idx)
+                self.positions[moved_idx] = new_idx
+                self.order[pos] = new_idx
+
+    def position(self, idx):
+        if idx < 0:
+            return -1
+        return self.positions[idx]
+
+    def drop_first(self, count):
+        # Removes indices 0 to count - 1, the rest are shifted down
+        self.order = array.array(
+                'l', [idx - count for idx in self.order if idx >= count])
+        self.positions = array.array(
+                'l', bytes(self.order.itemsize * len(self.order)))
+        for pos, idx in enumerate(self.order):
+            self.positions[idx] = pos
+
+    def next(self, idx):
+        return self.order[(self.position(idx) + 1) % len(self.order)]
+
+    def prev(self, idx):
+        return self.order[(self.position(idx) - 1) % len(self.order)]
+
+
 class Mpg123:
-    MSG_TYPE_RE = re.compile(b'^(@[A-Za-z0-9]+)\s+')
+    MSG_TYPE_RE = re.compile(rb'^(@[A-Za-z0-9]+)\s+')
     REQUEST_TIMEOUT = (5, 5)
+    # Resolve the next song when the current one has this many seconds left
+    PREFETCH_SECONDS = 30
+    SONG_DETAIL_BATCH_SIZE = 200
+    # Fetch details for this many songs from the one to be played, when
+    # they are not known yet
+    HYDRATE_WINDOW = 10
+    # API codes below 500 that are worth sending scrobbling logs again
+    # for: not logged in (until the cookies get refreshed) and throttled.
+    # Logs refused with any other code are dropped.
+    WEBLOG_RETRY_CODES = [301, -460]
+    # Fetch more radio songs when no more than this many are left to play
+    RADIO_REFILL_THRESHOLD = 2
+    # Radio songs already seen are skipped, up to this many. Songs played
+    # are also removed from the front of the playlist past this size.
+    RADIO_HISTORY_SIZE = 500
+    # personal_fm calls to make for a refill, when they keep returning
+    # songs we've already got
+    RADIO_REFILL_ATTEMPTS = 3
+    # Bytes to read from mpg123 at once
+    READ_SIZE = 64 * 1024
+    # Instead of handling ~38 @F messages per second, ask mpg123 where it
+    # is this often (in seconds), with the SAMPLE command
+    PROGRESS_POLL_INTERVAL = 1
+    PROGRESS_WAIT_TIMEOUT = 1
+    SAMPLES_PER_FRAME = 1152
+    DEFAULT_SAMPLE_RATE = 44100
 
     def __init__(self, binary=None, extra_args=None, api=None,
-            lastfm_api=None, loop=None, logger_factory=AsyncLogger):
+            lastfm_api=None, loop=None, logger_factory=AsyncLogger,
+            url_cache=None, metadata_store=None, audio_cache=None,
+            weblog_journal=None, lastfm_journal=None, page_cache=None):
         if binary is None:
             binary = 'mpg123'
+        # Either a path, or a command line as a list, e.g.
+        # [sys.executable, '-m', 'music163.fakempg123']
         self.binary = binary
         if extra_args is None:
             extra_args = []
         self.extra_args = extra_args
-        self.api = api
-        self.lastfm_api = lastfm_api
         if api is not None:
+            if not isinstance(api, AsyncMusic163API):
+                api = AsyncMusic163API.from_api(api)
             api.set_request_timeout(self.REQUEST_TIMEOUT)
+        self.api = api
+        if lastfm_api is not None and lastfm_api.request_timeout is None:
+            lastfm_api.request_timeout = self.REQUEST_TIMEOUT
+        self.lastfm_api = lastfm_api
+        if url_cache is None:
+            url_cache = UrlCache()
+        self.url_cache = url_cache
+        if metadata_store is None:
+            metadata_store = MetadataStore()
+        self.metadata_store = metadata_store
+        if page_cache is None:
+            page_cache = PageCache()
+        self.page_cache = page_cache
+        self.page_executor = None
+        self.audio_cache = audio_cache
+        self.audio_caching = False
+        self.downloads = {}
         self.loop = loop or asyncio.get_event_loop()
+        if weblog_journal is None:
+            weblog_journal = Journal()
+        # Scrobbling logs for music.163.com are sent in batches
+        self.weblog_flusher = JournalFlusher(
+                weblog_journal, self.send_weblog_batch,
+                on_error=self.handle_weblog_error,
+                on_reject=self.handle_weblog_rejected, loop=self.loop)
+        if lastfm_api is not None:
+            if lastfm_journal is None:
+                lastfm_journal = Journal()
+            self.lastfm_scrobbler = LastFMScrobbler(
+                    lastfm_api, lastfm_journal,
+                    on_error=self.handle_lastfm_error,
+                    on_reject=self.handle_lastfm_rejected, loop=self.loop)
+        else:
+            self.lastfm_scrobbler = None
         self.playlist = []
         self.current_song = -1
         self.shuffle = False
+        self.shuffle_order = None
         self.scrobbling = False
         self.default_bitrate = 320000
         self.playing_state = 'stopped'
-        self.frame_info = None
+        self._frame_info = None
+        # The latest @F message, parsed only when frame_info is read
+        self._frame_msg = None
+        self.sample_rate = self.DEFAULT_SAMPLE_RATE
+        # 'frames': mpg123 reports the progress with @F messages
+        # 'samples': @F is silenced, and we ask for @SAMPLE periodically
+        # 'unsupported': mpg123 doesn't know SAMPLE, keep using @F
+        self.progress_mode = 'frames'
+        self.progress_timer = None
+        self.progress_waiters = []
+        self.prefetch_task = None
+        self.prefetch_target = None
+        self.prefetch_generation = 0
+        self.hydrate_task = None
+        # song ID -> future, for details being fetched
+        self.pending_details = {}
+        self.search_cache = ResultCache()
+        # (query, type, limit, offset) -> task, for searches in flight
+        self.pending_searches = {}
+        self.suggest_cache = ResultCache()
+        self.pending_suggestions = {}
+        self.radio = False
+        self.radio_task = None
+        self.radio_history = collections.deque()
+        self.radio_seen = set()
         self.logger_factory = logger_factory
         self.msg_handlers = {
             b'@R': self._on_version_info,
@@ -898,21 +1248,32 @@ class Mpg123:
             b'@S': self._on_stream_info, # stream info
             b'@I': self._on_ignore, # (ID3) info
             b'@H': self._on_help,
+            b'@SAMPLE': self._on_sample,
         }
 
     async def start(self):
         self.stdio = await async_stdio(loop=self.loop)
         self.logger = self.logger_factory(self.stdio[1])
+        await self.start_process()
+
+    async def start_process(self):
+        if isinstance(self.binary, str):
+            player_cmd = [self.binary]
+        else:
+            player_cmd = list(self.binary)
         self.process = \
                 await asyncio.create_subprocess_exec(
-                        self.binary, '--remote', *self.extra_args,
+                        *player_cmd, '--remote', *self.extra_args,
                         stdin=subprocess.PIPE,
                         stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        loop=self.loop)
+                        stderr=subprocess.PIPE)
 
     async def run(self):
         await self.start()
+        if self.api is not None:
+            self.weblog_flusher.start()
+        if self.lastfm_scrobbler is not None:
+            self.lastfm_scrobbler.start()
         self.reader_handle = \
                 asyncio.ensure_future(self.read_cmd())
         self.dispatcher_handle = \
@@ -924,6 +1285,7 @@ class Mpg123:
 
         self.reader_handle.cancel()
         self.dispatcher_handle.cancel()
+        self.stop_progress_polling()
         self.process.kill()
         try:
             await self.reader_handle
@@ -934,6 +1296,27 @@ class Mpg123:
         except asyncio.CancelledError:
             pass
         await self.process.wait()
+        downloads = list(self.downloads.values())
+        for d in downloads:
+            d.cancel()
+        await asyncio.gather(*downloads, return_exceptions=True)
+        self.cancel_hydration()
+        self.stop_radio()
+        if self.page_executor is not None:
+            # Waiting for the workers to exit would block the loop
+            await self.loop.run_in_executor(None, self.page_executor.shutdown)
+            self.page_executor = None
+        searches = list(self.pending_searches.values()) + \
+                list(self.pending_suggestions.values())
+        for t in searches:
+            t.cancel()
+        await asyncio.gather(*searches, return_exceptions=True)
+        if self.lastfm_scrobbler is not None:
+            await self.lastfm_scrobbler.close()
+        if self.api is not None:
+            await self.weblog_flusher.close()
+            await self.api.close()
+        await self.logger.flush()
 
     async def invoke_player_command(self, cmd_factory, *args):
         cmd = cmd_factory(self, self.api, self.logger)
@@ -955,9 +1338,38 @@ class Mpg123:
                 self.process.stdin.write(line)
 
     async def dispatch(self):
-        async for line in self.process.stdout:
-            #self.stdio[1].write('Message from mpg123: {}\n'.format(line).encode())
-            self.handle_msg(line.strip())
+        self.start_progress_polling()
+        stdout = self.process.stdout
+        partial = b''
+        while True:
+            data = await stdout.read(self.READ_SIZE)
+            if not data:
+                break
+            lines = data.split(b'\n')
+            if partial:
+                lines[0] = partial + lines[0]
+            # Not a whole line yet
+            partial = lines.pop()
+            self.handle_msgs(lines)
+        if partial:
+            self.handle_msgs([partial])
+
+    def handle_msgs(self, lines):
+        # Only the last one of consecutive @F messages matters, the
+        # others are outdated already
+        last_frame = None
+        for line in lines:
+            if line.startswith(b'@F '):
+                last_frame = line
+                continue
+            if last_frame is not None:
+                self._on_frame(last_frame)
+                last_frame = None
+            line = line.rstrip()
+            if line:
+                self.handle_msg(line)
+        if last_frame is not None:
+            self._on_frame(last_frame.rstrip())
 
     def handle_cmd_exception(self, e):
         if isinstance(e, PlayerAPIError):
@@ -969,9 +1381,11 @@ class Mpg123:
         elif isinstance(e, (PlayerError, PlayerCmdError)):
             err_msg = e.args[0]
             self.logger.error(err_msg)
-        elif isinstance(e, (requests.Timeout, requests.ConnectTimeout, requests.ReadTimeout)):
+        elif isinstance(e, (requests.Timeout, requests.ConnectTimeout,
+                requests.ReadTimeout, asyncio.TimeoutError)):
             self.logger.error('Timed out')
-        elif isinstance(e, requests.ConnectionError):
+        elif isinstance(e, (requests.ConnectionError,
+                aiohttp.ClientConnectionError)):
             self.logger.error('Failed to connect to the server')
         else:
             raise e
@@ -982,9 +1396,11 @@ class Mpg123:
             self.handle_cmd_exception(exc)
 
     def handle_scrobbling_exception(self, e):
-        if isinstance(e, (requests.Timeout, requests.ConnectTimeout, requests.ReadTimeout)):
+        if isinstance(e, (requests.Timeout, requests.ConnectTimeout,
+                requests.ReadTimeout, asyncio.TimeoutError)):
             self.logger.error('Scrobbler timed out')
-        elif isinstance(e, requests.ConnectionError):
+        elif isinstance(e, (requests.ConnectionError,
+                aiohttp.ClientConnectionError)):
             self.logger.error('Failed to connect to the scrobbling server')
         else:
             raise e
@@ -1019,7 +1435,15 @@ class Mpg123:
         self.logger.info('Using player version: {}'.format(msg[3:].decode()))
 
     def _on_error(self, msg):
-        self.logger.error('mpg123: {}'.format(msg[3:].decode()))
+        err = msg[3:].decode()
+        if self.progress_mode == 'frames' and \
+                err.startswith('Unknown command') and \
+                err.lower().endswith('sample'):
+            # An older mpg123, stick to the @F messages
+            self.progress_mode = 'unsupported'
+            self.stop_progress_polling()
+            return
+        self.logger.error('mpg123: {}'.format(err))
 
     def _on_play(self, msg):
         stat_str = msg[3:]
@@ -1040,15 +1464,100 @@ class Mpg123:
         else:
             self.logger.warning('Unknown state: {}'.format(stat))
 
+    @property
+    def frame_info(self):
+        # (frames played, frames left, seconds played, seconds left), the
+        # "left" ones are None when the length of the song is not known
+        msg = self._frame_msg
+        if msg is not None:
+            frame_info = msg[3:].split(b' ')
+            self._frame_info = \
+                    (int(frame_info[0]), int(frame_info[1]),
+                            float(frame_info[2]), float(frame_info[3]))
+            self._frame_msg = None
+        return self._frame_info
+
+    @frame_info.setter
+    def frame_info(self, frame_info):
+        self._frame_info = frame_info
+        self._frame_msg = None
+
     def _on_frame(self, msg):
-        frame_info = msg[3:].split(b' ')
-        self.frame_info = \
-                (int(frame_info[0]), int(frame_info[1]),
-                        float(frame_info[2]), float(frame_info[3]))
+        self._frame_msg = msg
+        if self.prefetch_task is None and self.is_playing():
+            seconds_left = float(msg[msg.rindex(b' ') + 1:])
+            if seconds_left <= self.PREFETCH_SECONDS:
+                self.start_prefetch()
+
+    def _on_sample(self, msg):
+        if self.progress_mode == 'frames':
+            # SAMPLE works, so the @F messages are not needed any more
+            self.invoke_cmd('SILENCE')
+            self.progress_mode = 'samples'
+        sample_info = msg[8:].split(b' ')
+        played = int(sample_info[0])
+        total = int(sample_info[1])
+        rate = self.sample_rate
+        if total < 0:
+            # mpg123 reports -1 when it doesn't know the length (yet)
+            self.frame_info = (
+                    played // self.SAMPLES_PER_FRAME, None,
+                    played / rate, None)
+        else:
+            left = max(0, total - played)
+            self.frame_info = (
+                    played // self.SAMPLES_PER_FRAME,
+                    left // self.SAMPLES_PER_FRAME,
+                    played / rate, left / rate)
+        if self.prefetch_task is None and \
+                self.frame_info[3] is not None and \
+                self.frame_info[3] <= self.PREFETCH_SECONDS and \
+                self.is_playing():
+            self.start_prefetch()
+        waiters = self.progress_waiters
+        self.progress_waiters = []
+        for w in waiters:
+            if not w.done():
+                w.set_result(None)
 
     def _on_stream_info(self, msg):
+        # e.g. @S 1.0 3 44100 Joint-Stereo 0 1044 2 0 0 0 320 0 1
+        stream_info = msg[3:].split(b' ')
+        try:
+            self.sample_rate = int(stream_info[2])
+        except (IndexError, ValueError):
+            self.sample_rate = self.DEFAULT_SAMPLE_RATE
         self.now_playing()
 
+    def start_progress_polling(self):
+        if self.progress_timer is None and \
+                self.progress_mode != 'unsupported':
+            self.progress_timer = self.loop.call_later(
+                    self.PROGRESS_POLL_INTERVAL, self._poll_progress)
+
+    def stop_progress_polling(self):
+        if self.progress_timer is not None:
+            self.progress_timer.cancel()
+            self.progress_timer = None
+
+    def _poll_progress(self):
+        self.progress_timer = None
+        if self.is_playing():
+            self.invoke_cmd('SAMPLE')
+        self.start_progress_polling()
+
+    async def update_progress(self):
+        # Get the latest position, instead of the one from the last poll
+        if self.progress_mode != 'samples' or not self.is_playing():
+            return
+        waiter = self.loop.create_future()
+        self.progress_waiters.append(waiter)
+        self.invoke_cmd('SAMPLE')
+        try:
+            await asyncio.wait_for(waiter, self.PROGRESS_WAIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+
     def _on_help(self, msg):
         if msg[3] != ord('{') and msg[3] != ord('}'):
             self.logger.info(msg[3:].decode())
@@ -1063,11 +1572,100 @@ class Mpg123:
     async def call_api(self, api_func, *api_args, notice=None, err_msg=None):
         if notice is not None:
             self.logger.info(notice)
-        r = await self.loop.run_in_executor(None, api_func.__call__, *api_args)
+        r = await api_func(*api_args)
         if r['code'] != 200:
             raise PlayerAPIError(r, err_msg)
         return r
 
+    def get_page_executor(self):
+        # Pages are parsed in other processes, to use all the cores
+        if self.page_executor is None:
+            self.page_executor = make_parse_executor()
+        return self.page_executor
+
+    async def search(self, query, search_type, limit, offset,
+                     notice=None, err_msg=None):
+        key = (query, search_type, limit, offset)
+        r = self.search_cache.get(key)
+        if r is not None:
+            return r
+        task = self.pending_searches.get(key)
+        if task is None:
+            if notice is not None:
+                self.logger.info(notice)
+            task = self._start_search(key)
+        # Cancelling one waiter shouldn't cancel the search for others
+        try:
+            r = await asyncio.shield(task)
+        except PlayerAPIError as e:
+            raise PlayerAPIError(e.args[0], err_msg)
+        return r
+
+    def prefetch_search(self, query, search_type, limit, offset):
+        key = (query, search_type, limit, offset)
+        if key in self.pending_searches or \
+                self.search_cache.get(key) is not None:
+            return
+        self._start_search(key)
+
+    def _start_search(self, key):
+        task = asyncio.ensure_future(
+                self.call_api(self.api.cloudsearch_get_web, *key))
+        self.pending_searches[key] = task
+        task.add_done_callback(functools.partial(self._finish_search, key))
+        return task
+
+    def _finish_search(self, key, task):
+        del self.pending_searches[key]
+        # Failed searches are not cached, and the errors of prefetches
+        # nobody asked for are simply dropped
+        if task.cancelled() or task.exception() is not None:
+            return
+        self.search_cache.put(key, task.result())
+
+    async def suggest(self, query, limit, notice=None, err_msg=None):
+        key = ' '.join(query.lower().split())
+        r = self.suggest_cache.get(key)
+        if r is not None:
+            return r
+
+        task = self.pending_suggestions.get(key)
+        if task is None:
+            if notice is not None:
+                self.logger.info(notice)
+            task = asyncio.ensure_future(
+                    self.call_api(self.api.search_suggest_web, query, limit))
+            self.pending_suggestions[key] = task
+            task.add_done_callback(
+                    functools.partial(self._finish_suggest, key))
+        try:
+            r = await asyncio.shield(task)
+        except PlayerAPIError as e:
+            raise PlayerAPIError(e.args[0], err_msg)
+        return r
+
+    def _finish_suggest(self, key, task):
+        del self.pending_suggestions[key]
+        if task.cancelled() or task.exception() is not None:
+            return
+        self.suggest_cache.put(key, task.result())
+
+    async def fetch_song_url(self, song, notice=None):
+        br = self.default_bitrate
+        url_info = self.url_cache.get(song.id, br)
+        if url_info is not None:
+            return url_info['url']
+
+        r = await self.call_api(
+                self.api.song_enhance_player_url,
+                [song.id], br,
+                notice=notice,
+                err_msg='Failed to fetch stream URL')
+        if len(r['data']) == 0 or r['data'][0]['url'] is None:
+            raise PlayerError('Null stream URL')
+        self.url_cache.put_many(r['data'], br)
+        return r['data'][0]['url']
+
     async def play_song_in_playlist(self, idx):
         if idx >= 0 and idx < len(self.playlist):
             self.current_song = idx
@@ -1078,59 +1676,318 @@ class Mpg123:
                 msg = 'Playlist index out of range'
             raise PlayerError(msg)
 
+        self.check_radio_queue()
         song = self.playlist[idx]
-        display_name = get_song_display_name(song)
+        if song.is_placeholder():
+            playlist = self.playlist
+            try:
+                await self.hydrate_tracks(
+                        playlist, self.get_upcoming_indices(idx))
+            except Exception as e:
+                # Not fatal, the song can be played without details
+                self.logger.warning('Failed to fetch song details: {}'.format(e))
+            song = playlist[idx]
+        display_name = song.display_name
         self.logger.info('')
         self.logger.info('--=<  {}. {}  >=--'.format(idx, display_name))
         self.logger.info('')
 
-        r = await self.call_api(
-                self.api.song_enhance_player_url,
-                [song['id']], self.default_bitrate,
-                notice='Fetching stream URL...',
-                err_msg='Failed to fetch stream URL')
-        if len(r['data']) == 0 or r['data'][0]['url'] is None:
-            raise PlayerError('Null stream URL')
-        self.invoke_cmd('LOAD {}'.format(r['data'][0]['url']))
+        filename = self.get_cached_audio(song)
+        if filename is not None:
+            self.cancel_prefetch()
+            self.invoke_cmd('LOAD {}'.format(filename))
+            return
 
-    def shuffle_playlist(self):
-        self.shuffle = list(range(len(self.playlist)))
-        random.shuffle(self.shuffle)
+        url = await self.take_prefetched_url(idx, song)
+        if url is None:
+            url = await self.fetch_song_url(
+                    song, notice='Fetching stream URL...')
+        self.invoke_cmd('LOAD {}'.format(url))
+        self.start_download(song, url)
+
+    def get_cached_audio(self, song):
+        if self.audio_caching:
+            return self.audio_cache.get(song.id, self.default_bitrate)
+        return None
+
+    def start_download(self, song, url):
+        key = (song.id, self.default_bitrate)
+        if not self.audio_caching or key in self.downloads or \
+                self.audio_cache.get(*key) is not None:
+            return
+        url_info = self.url_cache.get(*key)
+        if url_info is not None:
+            md5 = url_info.get('md5')
+        else:
+            md5 = None
+        task = asyncio.ensure_future(self.download_song(key, url, md5))
+        task.add_done_callback(self.check_download_task)
+        self.downloads[key] = task
 
-    async def play_next_song(self):
-        playlist_len = len(self.playlist)
-        if playlist_len > 0:
+    async def download_song(self, key, url, md5=None):
+        out_file, tmp_filename = self.audio_cache.open_temp()
+        try:
+            with out_file:
+                digest = await self.api.download(url, out_file)
+            if md5 is not None and digest != md5.lower():
+                raise PlayerError('Checksum mismatch')
+        except:
+            self.audio_cache.discard(tmp_filename)
+            raise
+        finally:
+            del self.downloads[key]
+        self.audio_cache.commit(key[0], key[1], tmp_filename)
+
+    def check_download_task(self, future):
+        if future.cancelled():
+            return
+        e = future.exception()
+        if e is not None:
+            self.logger.warning('Failed to cache song: {}'.format(e))
+
+    def start_prefetch(self):
+        next_idx = self.get_next_song_index()
+        song = self.playlist[next_idx]
+        if song is None or self.get_cached_audio(song) is not None:
+            # Radio placeholder or cached song, nothing to resolve
+            self.prefetch_task = self.loop.create_future()
+            self.prefetch_task.set_result(None)
+            return
+        self.prefetch_target = \
+                (next_idx, song.id, self.default_bitrate)
+        self.prefetch_task = asyncio.ensure_future(self._prefetch_song(song))
+        self.prefetch_task.add_done_callback(self.check_prefetch_task)
+
+    async def _prefetch_song(self, song):
+        url = await self.fetch_song_url(song)
+        # Fill the audio cache ahead of time, so that the song can be
+        # loaded from the local file
+        self.start_download(song, url)
+        return url
+
+    def check_prefetch_task(self, future):
+        # A failed prefetch is not an error, the song will be resolved
+        # again when it's actually played
+        if not future.cancelled():
+            future.exception()
+
+    async def take_prefetched_url(self, idx, song):
+        task = self.prefetch_task
+        target = self.prefetch_target
+        generation = self.prefetch_generation
+        if task is None or target != (idx, song.id, self.default_bitrate):
+            self.cancel_prefetch()
+            return None
+
+        try:
+            url = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise
+            url = None
+        except Exception:
+            url = None
+        if generation != self.prefetch_generation:
+            # Playlist, shuffle state or bitrate changed while waiting
+            return None
+        self.cancel_prefetch()
+        return url
+
+    def cancel_prefetch(self):
+        self.prefetch_generation += 1
+        if self.prefetch_task is not None:
+            self.prefetch_task.cancel()
+        self.prefetch_task = None
+        self.prefetch_target = None
+
+    async def fetch_song_details(self, song_ids, notice=None, err_msg=None):
+        store = self.metadata_store
+        found, missing = store.get_many('song', song_ids)
+        for n in range(0, len(missing), self.SONG_DETAIL_BATCH_SIZE):
+            r = await self.call_api(
+                    self.api.song_detail,
+                    missing[n:n+self.SONG_DETAIL_BATCH_SIZE],
+                    notice=notice, err_msg=err_msg)
+            notice = None
+            store.put_songs(r['songs'])
+            for s in r['songs']:
+                found[s['id']] = s
+        return found
+
+    async def hydrate_tracks(self, playlist, indices):
+        song_ids = set()
+        for i in indices:
+            t = playlist[i]
+            if t is not None and t.is_placeholder():
+                song_ids.add(t.id)
+        if not song_ids:
+            return
+
+        # Don't fetch what's already being fetched, e.g. by the
+        # background task
+        waiting = [sid for sid in song_ids if sid in self.pending_details]
+        to_fetch = [sid for sid in song_ids if sid not in self.pending_details]
+        found = {}
+        if to_fetch:
+            fut = self.loop.create_future()
+            for sid in to_fetch:
+                self.pending_details[sid] = fut
+            try:
+                found = await self.fetch_song_details(
+                        to_fetch, err_msg='Failed to fetch song details')
+            finally:
+                for sid in to_fetch:
+                    del self.pending_details[sid]
+                fut.set_result(None)
+        if waiting:
+            await asyncio.gather(
+                    *set([self.pending_details[sid] for sid in waiting
+                          if sid in self.pending_details]))
+            waiting_found, _missing = \
+                    self.metadata_store.get_many('song', waiting)
+            found.update(waiting_found)
+
+        for i in indices:
+            t = playlist[i]
+            if t is not None and t.is_placeholder() and t.id in found:
+                playlist[i] = Track.from_song(found[t.id])
+
+    async def hydrate_playlist(self, playlist):
+        for n in range(0, len(playlist), self.SONG_DETAIL_BATCH_SIZE):
+            end = min(n + self.SONG_DETAIL_BATCH_SIZE, len(playlist))
+            try:
+                await self.hydrate_tracks(playlist, range(n, end))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # These songs get fetched again when they're about to be
+                # played
+                self.logger.warning(
+                        'Failed to fetch details for song #{} to #{}: {}'
+                        .format(n, end - 1, e))
+
+    def check_hydrate_task(self, future):
+        if future.cancelled():
+            return
+        e = future.exception()
+        if e is not None:
+            self.logger.warning('Failed to fetch song details: {}'.format(e))
+
+    def cancel_hydration(self):
+        if self.hydrate_task is not None:
+            self.hydrate_task.cancel()
+            self.hydrate_task = None
+
+    def get_upcoming_indices(self, idx, count=None):
+        if count is None:
+            count = self.HYDRATE_WINDOW
+        count = min(count, len(self.playlist))
+        indices = [idx]
+        for _ in range(count - 1):
             if self.shuffle:
-                if isinstance(self.shuffle, bool):
-                    self.shuffle_playlist()
-                if self.current_song >= 0:
-                    current_idx = self.shuffle.index(self.current_song)
-                else:
-                    current_idx = -1
-                next_idx = (current_idx + 1) % playlist_len
-                next_idx = self.shuffle[next_idx]
+                idx = self.get_shuffle_order().next(idx)
             else:
-                next_idx = (self.current_song + 1) % playlist_len
+                idx = (idx + 1) % len(self.playlist)
+            indices.append(idx)
+        return indices
 
-            if self.playlist[next_idx] is None:
-                task = asyncio.ensure_future(
-                        self.invoke_player_command(CmdPlay, 'play', 'radio'))
-                task.add_done_callback(self.check_cmd_task)
-            else:
-                await self.play_song_in_playlist(next_idx)
+    def shuffle_playlist(self):
+        self.shuffle_order = ShuffleOrder(len(self.playlist))
+        self.cancel_prefetch()
+
+    def set_shuffle(self, state):
+        self.shuffle = bool(state)
+        if self.shuffle and self.playlist:
+            self.shuffle_playlist()
+        else:
+            self.shuffle_order = None
+            self.cancel_prefetch()
+
+    def get_shuffle_order(self):
+        if self.shuffle_order is None:
+            self.shuffle_playlist()
+        return self.shuffle_order
+
+    def get_next_song_index(self):
+        if self.shuffle:
+            return self.get_shuffle_order().next(self.current_song)
+        else:
+            return (self.current_song + 1) % len(self.playlist)
 
+    def get_prev_song_index(self):
+        if self.shuffle:
+            return self.get_shuffle_order().prev(self.current_song)
+        else:
+            return (self.current_song - 1) % len(self.playlist)
+
+    async def play_next_song(self):
+        if self.radio and self.playlist and self.count_upcoming_songs() <= 0:
+            # Wait for more songs, instead of starting over
+            self.check_radio_queue()
+            if self.radio_task is not None:
+                # Errors are reported by check_radio_task(), just play
+                # what we've got in that case
+                await asyncio.wait([self.radio_task])
+        await self._play_song_at(self.get_next_song_index)
+
+    async def play_prev_song(self):
+        await self._play_song_at(self.get_prev_song_index)
+
+    async def _play_song_at(self, get_index):
+        playlist_len = len(self.playlist)
+        if playlist_len > 0:
+            next_idx = get_index()
+            await self.play_song_in_playlist(next_idx)
         else:
             self.current_song = -1
             raise PlayerError('Playlist is empty')
 
     def send_scrobbling_logs(self, logs):
-        logs = self.api.format_scrobbling_logs(logs)
-        task = asyncio.ensure_future(
-                self.call_api(
-                    self.api.feedback_weblog, logs,
-                    notice='Sending scrobbling log(s)...',
-                    err_msg='Failed to send scrobbling log(s)'))
-        task.add_done_callback(self.check_scrobbling_task)
+        for l in logs:
+            self.weblog_flusher.add(l)
+
+    async def send_weblog_batch(self, logs):
+        try:
+            await self.call_api(
+                    self.api.feedback_weblog,
+                    self.api.format_scrobbling_logs(logs),
+                    notice='Sending {} scrobbling log(s)...'.format(len(logs)))
+        except PlayerAPIError as e:
+            code = e.args[0].get('code')
+            if code not in self.WEBLOG_RETRY_CODES and \
+                    not (isinstance(code, int) and code >= 500):
+                raise RejectedBatchError(e.args[0])
+            raise
+
+    def handle_weblog_error(self, e, retry_delay):
+        self.logger.error(
+                'Failed to send scrobbling log(s), retrying in {} seconds'
+                .format(retry_delay))
+        self.handle_flush_exception(e)
+
+    def handle_weblog_rejected(self, e, logs):
+        self.logger.error(
+                'Scrobbling log(s) rejected by the server, dropped {} log(s)'
+                .format(len(logs)))
+        self.logger.error('api: {}'.format(e.args[0]))
+
+    def handle_lastfm_error(self, e, retry_delay):
+        self.logger.error(
+                'Failed to send scrobble(s) to LastFM, retrying in {} seconds'
+                .format(retry_delay))
+        self.handle_flush_exception(e)
+
+    def handle_lastfm_rejected(self, e, scrobbles):
+        self.logger.error(
+                'Scrobble(s) rejected by LastFM, dropped {} scrobble(s)'
+                .format(len(scrobbles)))
+        self.logger.error('api: {}'.format(e.args[0]))
+
+    def handle_flush_exception(self, e):
+        if isinstance(e, (PlayerAPIError, APIError)):
+            self.logger.error('api: {}'.format(e.args[0]))
+        else:
+            self.handle_scrobbling_exception(e)
 
     def now_playing(self):
         if self.scrobbling and self.playlist and self.current_song >= 0:
@@ -1145,37 +2002,54 @@ class Mpg123:
             logs = [{
                 'action': 'play',
                 'json': {
-                    'id': cur_song['id'],
+                    'id': cur_song.id,
                     'type': 'song',
                 }
             }]
             self.send_scrobbling_logs(logs)
 
-            if self.lastfm_api is not None:
+            # Can't tell LastFM anything useful without the song details
+            if self.lastfm_api is not None and not cur_song.is_placeholder():
                 self.logger.info('Sending Now-Playing info to LastFM...')
-                if cur_song['artists']:
-                    artist_name = cur_song['artists'][0]['name']
+                if cur_song.artist_names:
+                    artist_name = cur_song.artist_names[0]
                 else:
                     artist_name = 'Unknown Artist'
-                if cur_song['album']:
-                    album_name = cur_song['album']['name']
+                if cur_song.album_name is not None:
+                    album_name = cur_song.album_name
                 else:
                     album_name = 'Unknown Album'
                 task = asyncio.ensure_future(
                         self.loop.run_in_executor(
                             None, self.lastfm_api.track_update_now_playing.__call__,
-                            cur_song['name'], artist_name, album_name))
-                task.add_done_callback(self.check_lastfm_api_task)
+                            cur_song.name, artist_name, album_name))
+                task.add_done_callback(self.check_now_playing_task)
 
     def check_lastfm_api_task(self, future):
         try:
             r = future.result()
         except Exception as e:
             self.handle_scrobbling_exception(e)
-            return
+            return False
         if r[0][0] != 200 or 'error' in r[1]:
             self.logger.error('api: {}'.format(r))
             self.logger.error( 'Failed to call LastFM API')
+            return False
+        return True
+
+    def check_now_playing_task(self, future):
+        if self.check_lastfm_api_task(future):
+            # LastFM is reachable, no need to wait for the retry timer
+            self.lastfm_scrobbler.retry_now()
+
+    def lastfm_scrobblable(self):
+        seconds_played = self.frame_info[2]
+        seconds_left = self.frame_info[3]
+        if seconds_left is None:
+            # Without the length, only the 4 minutes rule can be checked
+            return seconds_played >= 240
+        return (seconds_played + seconds_left) > 30 and \
+                (seconds_played >= seconds_left or seconds_played >= 240)
 
     def scrobble(self, end_method='interrupt'):
         if self.scrobbling and self.playlist \
@@ -1193,40 +2067,139 @@ class Mpg123:
                 'action': 'play',
                 'json': {
                     'end': end_method,
-                    'id': last_song['id'],
+                    'id': last_song.id,
                     'time': seconds_played,
                     'type': 'song',
                 }
             }]
             self.send_scrobbling_logs(logs)
 
-            if self.lastfm_api is not None and \
-                    (self.frame_info[2] + self.frame_info[3]) > 30 and \
-                    (self.frame_info[2] >= self.frame_info[3] or \
-                        self.frame_info[2] >= 240):
-                self.logger.info('Sending scrobbling log to LastFM...')
-                if last_song['artists']:
-                    artist_name = last_song['artists'][0]['name']
+            if self.lastfm_scrobbler is not None and \
+                    not last_song.is_placeholder() and \
+                    self.lastfm_scrobblable():
+                if last_song.artist_names:
+                    artist_name = last_song.artist_names[0]
                 else:
                     artist_name = 'Unknown Artist'
-                if last_song['album']:
-                    album_name = last_song['album']['name']
+                if last_song.album_name is not None:
+                    album_name = last_song.album_name
                 else:
                     album_name = 'Unknown Album'
-                task = asyncio.ensure_future(
-                        self.loop.run_in_executor(
-                            None, self.lastfm_api.track_scrobble.__call__,
-                            last_song['name'], artist_name, album_name,
-                            str(int(datetime.utcnow().timestamp()))))
-                task.add_done_callback(self.check_lastfm_api_task)
+                self.lastfm_scrobbler.add({
+                    'track': last_song.name,
+                    'artist': artist_name,
+                    'album': album_name,
+                    'timestamp': str(int(datetime.utcnow().timestamp())),
+                })
+                self.logger.info(
+                        'Queued scrobbling log for LastFM ({} pending)'
+                        .format(len(self.lastfm_scrobbler.journal)))
 
     def set_playlist(self, playlist):
         self.scrobble(end_method='interrupt')
-        self.playlist = playlist
-        self.shuffle = bool(self.shuffle)
+        self.cancel_hydration()
+        self.stop_radio()
+        self.playlist = [Track.from_song(s) for s in playlist]
+        self.shuffle_order = None
+        self.cancel_prefetch()
+
+    def set_lazy_playlist(self, song_ids):
+        # Song details are fetched around the song being played, and for
+        # the rest of the playlist in the background
+        self.set_playlist([Track.placeholder(sid) for sid in song_ids])
+        self.hydrate_task = \
+                asyncio.ensure_future(self.hydrate_playlist(self.playlist))
+        self.hydrate_task.add_done_callback(self.check_hydrate_task)
+
+    def extend_playlist(self, songs):
+        self.playlist.extend([Track.from_song(s) for s in songs])
+        if self.shuffle_order is not None:
+            # Keep the songs played so far in this round where they are
+            self.shuffle_order.extend(
+                    len(songs),
+                    after=self.shuffle_order.position(self.current_song))
+        self.cancel_prefetch()
+
+    def count_upcoming_songs(self):
+        if self.shuffle and self.shuffle_order is not None:
+            pos = self.shuffle_order.position(self.current_song)
+        else:
+            pos = self.current_song
+        return len(self.playlist) - 1 - pos
+
+    def start_radio(self, songs):
+        self.set_playlist([])
+        self.radio = True
+        self.extend_radio(songs)
+
+    def stop_radio(self):
+        self.radio = False
+        if self.radio_task is not None:
+            self.radio_task.cancel()
+            self.radio_task = None
+
+    def extend_radio(self, songs):
+        new_songs = []
+        for s in songs:
+            if s['id'] in self.radio_seen:
+                continue
+            new_songs.append(s)
+            self.radio_seen.add(s['id'])
+            self.radio_history.append(s['id'])
+        while len(self.radio_history) > self.RADIO_HISTORY_SIZE:
+            self.radio_seen.discard(self.radio_history.popleft())
+        if new_songs:
+            self.extend_playlist(new_songs)
+            self.trim_radio()
+        return len(new_songs)
+
+    def trim_radio(self):
+        # Only the songs already played can go
+        excess = len(self.playlist) - self.RADIO_HISTORY_SIZE
+        if excess <= 0 or self.current_song <= 0:
+            return
+        if self.shuffle_order is not None:
+            cur_pos = self.shuffle_order.position(self.current_song)
+            count = 0
+            while count < excess and \
+                    self.shuffle_order.position(count) < cur_pos:
+                count += 1
+        else:
+            count = min(excess, self.current_song)
+        if count == 0:
+            return
+        del self.playlist[:count]
+        if self.shuffle_order is not None:
+            self.shuffle_order.drop_first(count)
+        self.current_song -= count
+        self.cancel_prefetch()
+
+    def check_radio_queue(self):
+        if self.radio and self.radio_task is None and \
+                self.count_upcoming_songs() <= self.RADIO_REFILL_THRESHOLD:
+            self.radio_task = asyncio.ensure_future(self.refill_radio())
+            self.radio_task.add_done_callback(self.check_radio_task)
+
+    async def refill_radio(self):
+        for _ in range(self.RADIO_REFILL_ATTEMPTS):
+            r = await self.call_api(
+                    self.api.personal_fm,
+                    err_msg='Failed to fetch song(s)')
+            if self.extend_radio(r['data']) > 0:
+                break
+
+    def check_radio_task(self, future):
+        if future is self.radio_task:
+            self.radio_task = None
+        if future.cancelled():
+            return
+        e = future.exception()
+        if e is not None:
+            self.handle_cmd_exception(e)
 
     def set_default_bitrate(self, br):
         self.default_bitrate = br
+        self.cancel_prefetch()
 
     def reset_current_song(self):
         self.current_song = -1
@@ -1,61 +1,150 @@
 import sys
-import configparser
+import asyncio
+import collections
 
+import aiohttp
 
-DEFAULT_PLAYLIST_FORMAT = 'simple'
-GET_URL_MAX_SONGS_COUNT = 50
+from .api import (APIError, AsyncMusic163API)
+from .cache import UrlCache
 
 
-def fetch_song_urls(api, song_list, br):
-    result = []
-    for n in range(0, len(song_list), GET_URL_MAX_SONGS_COUNT):
-        cur_songs = song_list[n:n+GET_URL_MAX_SONGS_COUNT]
-        song_ids_str = '[{}]'.format(','.join([str(s['id']) for s in cur_songs]))
-        r = api.song_enhance_player_url(song_ids_str, br)
-        if r['code'] != 200:
-            raise RuntimeError('Failed to fetch song URLs')
-        result.extend(r['data'])
-    return result
+DEFAULT_PLAYLIST_FORMAT = 'simple'
+DEFAULT_FETCH_CONCURRENCY = 8
+GET_URL_MAX_SONGS_COUNT = 50
 
 
-def generate_simple(api, song_list, bit_rate, out_file):
-    urls = fetch_song_urls(api, song_list, bit_rate)
-    for s, u in zip(song_list, urls):
-        if u['url'] is None:
-            artist_names = [a['name'] for a in s['artists']]
-            print('Warning: URL not found for song ID {}: {} - {}'
-                    .format(s['id'], s['name'], ','.join(artist_names)),
-                    file=sys.stderr)
+async def _fetch_url_chunk(api, song_list, br, url_cache):
+    found, missing = url_cache.get_many([s['id'] for s in song_list], br)
+    error = None
+    if missing:
+        song_ids_str = '[{}]'.format(','.join([str(sid) for sid in missing]))
+        try:
+            r = await api.song_enhance_player_url(song_ids_str, br)
+            if r['code'] != 200:
+                raise APIError(r)
+        except (APIError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = e
+        else:
+            url_cache.put_many(r['data'], br)
+            for u in r['data']:
+                found[u['id']] = u
+    urls = [found.get(s['id'], {'id': s['id'], 'url': None})
+            for s in song_list]
+    return (song_list, urls, error)
+
+
+def iter_song_url_chunks(api, song_list, br, url_cache=None,
+        concurrency=DEFAULT_FETCH_CONCURRENCY):
+    # Yields (offset, songs, urls, error) tuples in playlist order, while
+    # keeping up to `concurrency` chunks in flight
+    if url_cache is None:
+        url_cache = UrlCache()
+    async_api = AsyncMusic163API.from_api(api)
+    async_api.set_enc_key_reuse(True)
+    loop = asyncio.new_event_loop()
+    pending = collections.deque()
+
+    def wait_chunk():
+        offset, task = pending.popleft()
+        return (offset,) + loop.run_until_complete(task)
+
+    try:
+        for n in range(0, len(song_list), GET_URL_MAX_SONGS_COUNT):
+            cur_songs = song_list[n:n+GET_URL_MAX_SONGS_COUNT]
+            task = loop.create_task(
+                    _fetch_url_chunk(async_api, cur_songs, br, url_cache))
+            pending.append((n, task))
+            if len(pending) >= concurrency:
+                yield wait_chunk()
+        while pending:
+            yield wait_chunk()
+    finally:
+        tasks = [t for _, t in pending]
+        for t in tasks:
+            t.cancel()
+        if tasks:
+            loop.run_until_complete(
+                    asyncio.gather(*tasks, return_exceptions=True))
+        loop.run_until_complete(async_api.close())
+        loop.close()
+
+
+def warn_failed_chunk(offset, songs, error):
+    print('Warning: Failed to fetch URLs for song #{} to #{}: {}'
+            .format(offset, offset + len(songs) - 1, error),
+            file=sys.stderr)
+
+
+def iter_song_urls(api, song_list, br, url_cache=None,
+        concurrency=DEFAULT_FETCH_CONCURRENCY):
+    # Yields a list of (song, url_info) pairs as soon as each chunk is
+    # resolved, skipping the chunks that failed
+    n_chunks = 0
+    n_failed = 0
+    for offset, songs, urls, error in iter_song_url_chunks(
+            api, song_list, br, url_cache, concurrency):
+        n_chunks += 1
+        if error is not None:
+            n_failed += 1
+            warn_failed_chunk(offset, songs, error)
             continue
-        print(u['url'].strip(), file=out_file)
-
-
-def generate_pls(api, song_list, bit_rate, out_file):
-    urls = fetch_song_urls(api, song_list, bit_rate)
-
-    cp = configparser.ConfigParser()
-    cp = configparser.RawConfigParser()
-    cp.optionxform = lambda option: option  # Retain cases
-    cp.add_section('playlist')
+        yield list(zip(songs, urls))
+    if n_chunks > 0 and n_failed == n_chunks:
+        raise RuntimeError('Failed to fetch song URLs')
+
+
+def generate_simple(api, song_list, bit_rate, out_file, url_cache=None,
+        concurrency=DEFAULT_FETCH_CONCURRENCY):
+    for pairs in iter_song_urls(
+            api, song_list, bit_rate, url_cache, concurrency):
+        lines = []
+        for s, u in pairs:
+            if u['url'] is None:
+                artist_names = [a['name'] for a in s['artists']]
+                print('Warning: URL not found for song ID {}: {} - {}'
+                        .format(s['id'], s['name'], ','.join(artist_names)),
+                        file=sys.stderr)
+                continue
+            lines.append(u['url'].strip())
+            lines.append('\n')
+        out_file.write(''.join(lines))
+        out_file.flush()
+
+
+def _pls_entry(key, value):
+    # Same format as RawConfigParser.write(space_around_delimiters=False)
+    return '{}={}\n'.format(key, str(value).replace('\n', '\n\t'))
+
+
+def generate_pls(api, song_list, bit_rate, out_file, url_cache=None,
+        concurrency=DEFAULT_FETCH_CONCURRENCY):
+    out_file.write('[playlist]\n')
 
     i = 0
-    for s, u in zip(song_list, urls):
-        artist_names = [a['name'] for a in s['artists']]
-        song_name = '{} - {}'.format(s['name'], ','.join(artist_names))
+    for pairs in iter_song_urls(
+            api, song_list, bit_rate, url_cache, concurrency):
+        lines = []
+        for s, u in pairs:
+            artist_names = [a['name'] for a in s['artists']]
+            song_name = '{} - {}'.format(s['name'], ','.join(artist_names))
 
-        if u['url'] is None:
-            print('Warning: URL not found for song ID {}: {}'.format(s['id'], song_name),
-                    file=sys.stderr)
-            continue
+            if u['url'] is None:
+                print('Warning: URL not found for song ID {}: {}'.format(s['id'], song_name),
+                        file=sys.stderr)
+                continue
 
-        i += 1
-        cp['playlist']['File{}'.format(i)] = u['url']
-        cp['playlist']['Title{}'.format(i)] = song_name
-        cp['playlist']['Length{}'.format(i)] = str(round(s['duration'] / 1000))
+            i += 1
+            lines.append(_pls_entry('File{}'.format(i), u['url']))
+            lines.append(_pls_entry('Title{}'.format(i), song_name))
+            lines.append(_pls_entry(
+                'Length{}'.format(i), round(s['duration'] / 1000)))
+        out_file.write(''.join(lines))
+        out_file.flush()
 
-    cp['playlist']['NumberOfEntries'] = str(i)
-    cp['playlist']['Version'] = '2'
-    cp.write(out_file, space_around_delimiters=False)
+    out_file.write(_pls_entry('NumberOfEntries', i))
+    out_file.write(_pls_entry('Version', 2))
+    out_file.write('\n')
+    out_file.flush()
 
 
 _playlist_formats = {
@@ -64,6 +153,11 @@ _playlist_formats = {
 }
 
 
-def generate_playlist(pl_format, bit_rate, api, song_list, out_file):
+def get_playlist_formats():
+    return list(_playlist_formats)
+
+
+def generate_playlist(pl_format, bit_rate, api, song_list, out_file,
+        url_cache=None, concurrency=DEFAULT_FETCH_CONCURRENCY):
     gen_func = _playlist_formats[pl_format]
-    gen_func(api, song_list, bit_rate, out_file)
+    gen_func(api, song_list, bit_rate, out_file, url_cache, concurrency)
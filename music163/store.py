@@ -0,0 +1,118 @@
+import time
+import json
+import sqlite3
+
+
+def normalize_song(song):
+    # Newer APIs (e.g. /weapi/v3/playlist/detail) use 'ar', 'al' and 'dt'
+    # instead. Songs are stored with the older names too, which is what
+    # the playlist generators read.
+    if 'artists' in song and 'album' in song and 'duration' in song:
+        return song
+    song = dict(song)
+    song.setdefault('artists', song.get('ar') or [])
+    song.setdefault('album', song.get('al') or {})
+    song.setdefault('duration', song.get('dt'))
+    return song
+
+
+class MetadataStore:
+    # Seconds before a cached object is considered stale, per kind
+    TTLS = {
+        'playlist': 60 * 60,
+        'playlist_ids': 60 * 60,
+        'user_playlists': 10 * 60,
+        'song': 7 * 24 * 60 * 60,
+        'program': 7 * 24 * 60 * 60,
+    }
+    DEFAULT_TTL = 24 * 60 * 60
+    # SQLite limits the number of host parameters in a single statement
+    MAX_QUERY_IDS = 500
+    LOCK_TIMEOUT = 10
+
+    def __init__(self, filename=':memory:'):
+        self.filename = filename
+        # isolation_level=None means we manage transactions ourselves
+        self.conn = sqlite3.connect(
+                filename, timeout=self.LOCK_TIMEOUT, isolation_level=None)
+        # WAL mode lets the CLI read while a running player is writing
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS metadata ('
+                'kind TEXT NOT NULL, '
+                'id INTEGER NOT NULL, '
+                'update_time INTEGER, '
+                'fetch_time REAL NOT NULL, '
+                'body TEXT NOT NULL, '
+                'PRIMARY KEY (kind, id))')
+
+    def close(self):
+        self.conn.close()
+
+    def get_ttl(self, kind):
+        return self.TTLS.get(kind, self.DEFAULT_TTL)
+
+    def get(self, kind, obj_id, ttl=None):
+        found, _missing = self.get_many(kind, [obj_id], ttl)
+        return found.get(obj_id, None)
+
+    def get_many(self, kind, obj_ids, ttl=None):
+        if ttl is None:
+            ttl = self.get_ttl(kind)
+        min_fetch_time = time.time() - ttl
+
+        found = {}
+        for n in range(0, len(obj_ids), self.MAX_QUERY_IDS):
+            cur_ids = obj_ids[n:n+self.MAX_QUERY_IDS]
+            rows = self.conn.execute(
+                    'SELECT id, body FROM metadata '
+                    'WHERE kind = ? AND fetch_time >= ? AND id IN ({})'
+                    .format(','.join(['?'] * len(cur_ids))),
+                    [kind, min_fetch_time] + list(cur_ids))
+            for obj_id, body in rows:
+                found[obj_id] = json.loads(body)
+        if kind == 'song':
+            # Rows stored before put_songs() normalised them
+            for obj_id, obj in found.items():
+                found[obj_id] = normalize_song(obj)
+        missing = [i for i in obj_ids if i not in found]
+        return (found, missing)
+
+    def get_update_time(self, kind, obj_id):
+        row = self.conn.execute(
+                'SELECT update_time FROM metadata WHERE kind = ? AND id = ?',
+                (kind, obj_id)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def put(self, kind, obj_id, obj, update_time=None):
+        self.put_many(kind, [(obj_id, obj, update_time)])
+
+    def put_many(self, kind, items):
+        now = time.time()
+        rows = [(kind, obj_id, update_time, now, json.dumps(obj))
+                for obj_id, obj, update_time in items]
+        self.conn.execute('BEGIN')
+        try:
+            self.conn.executemany(
+                    'INSERT OR REPLACE INTO metadata '
+                    '(kind, id, update_time, fetch_time, body) '
+                    'VALUES (?, ?, ?, ?, ?)', rows)
+        except:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+
+    def delete_many(self, kind, obj_ids):
+        for n in range(0, len(obj_ids), self.MAX_QUERY_IDS):
+            cur_ids = obj_ids[n:n+self.MAX_QUERY_IDS]
+            self.conn.execute(
+                    'DELETE FROM metadata WHERE kind = ? AND id IN ({})'
+                    .format(','.join(['?'] * len(cur_ids))),
+                    [kind] + list(cur_ids))
+
+    def put_songs(self, songs):
+        self.put_many(
+                'song', [(s['id'], normalize_song(s), None) for s in songs])
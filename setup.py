@@ -44,9 +44,11 @@ setup(
         'lxml >= 3.4.4',
         'pycrypto >= 2.6.1',
         'requests >= 2.8.1',
+        'aiohttp >= 3.3',
     ],
     entry_points='''
     [console_scripts]
     {0} = {0}.__main__:main
+    {0}-fakempg123 = {0}.fakempg123:main
     '''.format(PACKAGE_NAME),
 )